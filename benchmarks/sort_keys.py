@@ -0,0 +1,56 @@
+# Micro-benchmark of sorting a 10k entry directory listing the way
+# get_raw_dir does on every browse.
+#
+#   python benchmarks/sort_keys.py  (with the plugin and its dependencies installed)
+from __future__ import print_function
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mopidy_subidy import subsonic_api  # noqa: E402
+
+random.seed(0)
+DIRITEMS = (
+    [dict(isDir=True, id='d%d' % i, title='Artist %d - Album %d (Disc %d)' % (i % 300, i, i % 3)) for i in range(5000)] +
+    [dict(isDir=False, id='s%d' % i, title='Song %d' % i, track=str(i % 20 + 1), discNumber=str(i % 2 + 1)) for i in range(5000)])
+random.shuffle(DIRITEMS)
+
+def legacy_string_nums_nocase_sort_key(s):
+    segments = []
+    for substr in re.split(r'(\d+)', s):
+        if substr.isdigit():
+            seg = int(substr)
+        else:
+            seg = substr.lower()
+        segments.append(seg)
+    return segments
+
+def legacy_diritem_sort_key(item):
+    isdir = item['isDir']
+    if isdir:
+        key = legacy_string_nums_nocase_sort_key(item['title'])
+    else:
+        key = int(item.get('track', 1))
+    return (isdir, key)
+
+def sort_legacy():
+    sorted(DIRITEMS, key=legacy_diritem_sort_key)
+
+def sort_cold():
+    subsonic_api.sort_keys.clear()
+    sorted(DIRITEMS, key=subsonic_api.diritem_sort_key)
+
+def sort_warm():
+    sorted(DIRITEMS, key=subsonic_api.diritem_sort_key)
+
+def main():
+    for name, fn in (('re.split (before)', sort_legacy), ('memo, cold', sort_cold), ('memo, warm', sort_warm)):
+        best = min(timeit.repeat(fn, number=1, repeat=7))
+        print('%-18s %7.2f ms per %d entry directory' % (name, best * 1000, len(DIRITEMS)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Micro-benchmark of uri parsing for a 100k track tracklist restore, which
+# calls get_type() and get_song_id() for every uri.
+#
+#   python benchmarks/uri_parsing.py
+from __future__ import print_function
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mopidy_subidy'))
+import uri  # noqa: E402 - imported directly to avoid pulling in mopidy
+
+URIS = [uri.get_song_uri('%x' % (i * 7919)) for i in range(100000)]
+
+legacy_regex = re.compile(r'(\w+?):(\w+?)(?::|$)(.+?)?$')
+
+def legacy_get_type(a_uri):
+    result = legacy_regex.match(a_uri)
+    if result is None or result.group(1) != uri.PREFIX:
+        return None
+    return result.group(2)
+
+def legacy_get_song_id(a_uri):
+    result = legacy_regex.match(a_uri)
+    if result is None or result.group(1) != uri.PREFIX or result.group(2) != uri.SONG:
+        return None
+    return result.group(3)
+
+def restore_legacy():
+    for a_uri in URIS:
+        if legacy_get_type(a_uri) == uri.SONG:
+            legacy_get_song_id(a_uri)
+
+def restore_cold():
+    uri.parsed_uris.clear()
+    for a_uri in URIS:
+        if uri.get_type(a_uri) == uri.SONG:
+            uri.get_song_id(a_uri)
+
+def restore_warm():
+    for a_uri in URIS[:uri.PARSE_CACHE_SIZE]:
+        if uri.get_type(a_uri) == uri.SONG:
+            uri.get_song_id(a_uri)
+
+def main():
+    # the memo keeps its default PARSE_CACHE_SIZE, so a 100k restore runs
+    # cold; the warm run repeats as many uris as the memo holds, like
+    # browsing and looking up the same uris again
+    for name, fn in (('regex (before)', restore_legacy), ('parse, cold memo', restore_cold), ('parse, warm memo', restore_warm)):
+        count = len(URIS) if fn is not restore_warm else min(len(URIS), uri.PARSE_CACHE_SIZE)
+        best = min(timeit.repeat(fn, number=1, repeat=20))
+        print('%-18s %7.1f ms  %5.2f us/uri' % (name, best * 1000, best * 1e6 / count))
+
+if __name__ == '__main__':
+    main()
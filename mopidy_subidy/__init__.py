@@ -26,6 +26,26 @@ class SubidyExtension(ext.Extension):
         schema['legacy_auth'] = config.Boolean(optional=True)
         schema['api_version'] = config.String(optional=True)
         schema['uri_prefix'] = config.String(optional=True)
+        schema['cache_size'] = config.Integer(minimum=0)
+        schema['cache_ttl'] = config.Integer(minimum=0, optional=True)
+        schema['cache_ttls'] = config.List(optional=True)
+        schema['max_requests'] = config.Integer(minimum=1)
+        schema['lookup_timeout'] = config.Integer(minimum=1)
+        schema['browse_timeout'] = config.Integer(minimum=1)
+        schema['search_timeout'] = config.Integer(minimum=1)
+        schema['search_max_results'] = config.Integer(minimum=1)
+        schema['search_pages'] = config.Integer(minimum=1)
+        schema['http_pool_size'] = config.Integer(minimum=1)
+        schema['http_timeout'] = config.Integer(minimum=1)
+        schema['coverart_cache_size'] = config.Integer(minimum=0)
+        schema['coverart_max_age'] = config.Integer(minimum=0)
+        schema['coverart_sizes'] = config.List(optional=True)
+        schema['snapshot'] = config.Boolean()
+        schema['snapshot_refresh_interval'] = config.Integer(minimum=60)
+        schema['backfill_albums'] = config.Integer(minimum=1)
+        schema['local_search'] = config.Boolean()
+        schema['album_bucket_threshold'] = config.Integer(minimum=0)
+        schema['browse_intervals'] = config.List(optional=True)
         return schema
 
     def setup(self, registry):
@@ -1,12 +1,39 @@
-from mopidy_subidy import library, playback, playlists, subsonic_api
+from mopidy_subidy import browse_lists, library, playback, playlists, snapshot, subsonic_api
 from mopidy import backend, httpclient
 import pykka
+import logging
+
+logger = logging.getLogger(__name__)
 
 class SubidyBackend(pykka.ThreadingActor, backend.Backend):
     def __init__(self, config, audio):
         super(SubidyBackend, self).__init__()
         self.subsonic_api = subsonic_api.get_subsonic_api_with_config(config)
+        self.album_bucket_threshold = config['subidy']['album_bucket_threshold']
+        self.browse_lists = browse_lists.BrowseLists(
+            self.subsonic_api, browse_lists.parse_intervals(config['subidy']['browse_intervals']))
+        self.list_prefetcher = None
         self.library = library.SubidyLibraryProvider(backend=self)
         self.playback = playback.SubidyPlaybackProvider(audio=audio, backend=self)
         self.playlists = playlists.SubidyPlaylistsProvider(backend=self)
         self.uri_schemes = ['subidy']
+        self.snapshot_refresh_interval = config['subidy']['snapshot_refresh_interval']
+        self.snapshot_refresher = None
+
+    def on_start(self):
+        self.list_prefetcher = browse_lists.ListPrefetcher(self.browse_lists)
+        self.list_prefetcher.start()
+        if self.subsonic_api.snapshot is not None:
+            self.snapshot_refresher = snapshot.SnapshotRefresher(
+                self.subsonic_api, self.snapshot_refresh_interval)
+            self.snapshot_refresher.start()
+
+    def on_stop(self):
+        logger.info('Subsonic connection stats: %s, coalesced requests: %s' % (
+            self.subsonic_api.transport.stats(), self.subsonic_api.single_flight.stats()))
+        if self.list_prefetcher is not None:
+            self.list_prefetcher.stop()
+        if self.snapshot_refresher is not None:
+            self.snapshot_refresher.stop()
+        if self.subsonic_api.snapshot is not None:
+            self.subsonic_api.snapshot.close()
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LIST_SIZE = 50
+
+# Seconds until a list whose refresh failed is tried again.
+RETRY_INTERVAL = 60
+
+# Default seconds between background refreshes of each list vdir.
+DEFAULT_INTERVALS = dict(
+    newest=3600,
+    recent=300,
+    frequent=3600,
+    starred=600,
+    random=900,
+    genres=3600,
+)
+
+def parse_intervals(entries):
+    intervals = {}
+    for entry in entries or ():
+        name, _, interval = entry.partition(':')
+        try:
+            intervals[name.strip()] = int(interval)
+        except ValueError:
+            logger.warning('Ignoring invalid browse interval entry: %s' % entry)
+    return intervals
+
+class BrowseLists(object):
+    # The small "home screen" lists are kept in memory and refreshed on
+    # their own interval by the ListPrefetcher, so browsing them does not
+    # wait for the server.
+    def __init__(self, subsonic_api, intervals=None):
+        self.subsonic_api = subsonic_api
+        self.intervals = dict(DEFAULT_INTERVALS)
+        self.intervals.update((name, interval) for name, interval in (intervals or {}).items() if name in DEFAULT_INTERVALS)
+        self.lock = threading.Lock()
+        self.lists = {}
+        self.fetched_at = {}
+        self.retry_at = {}
+
+    def __contains__(self, name):
+        return name in DEFAULT_INTERVALS
+
+    def fetch(self, name):
+        if name == 'starred':
+            return self.subsonic_api.get_starred_as_refs()
+        if name == 'random':
+            return self.subsonic_api.get_random_songs_as_refs(LIST_SIZE)
+        if name == 'genres':
+            return self.subsonic_api.get_genres_as_refs()
+        return self.subsonic_api.get_album_list_as_refs(name, LIST_SIZE, fresh=True)
+
+    def refresh(self, name):
+        # A failed fetch (None) keeps the previous list, if any, and is
+        # retried after RETRY_INTERVAL instead of the full interval.
+        refs = self.fetch(name)
+        with self.lock:
+            if refs is None:
+                self.retry_at[name] = time.time() + RETRY_INTERVAL
+                return self.lists.get(name)
+            self.lists[name] = refs
+            self.fetched_at[name] = time.time()
+            self.retry_at.pop(name, None)
+        return refs
+
+    def get(self, name):
+        with self.lock:
+            refs = self.lists.get(name)
+        if refs is None:
+            refs = self.refresh(name)
+        return list(refs or [])
+
+    def invalidate(self):
+        with self.lock:
+            self.lists.clear()
+            self.fetched_at.clear()
+            self.retry_at.clear()
+
+    def due_at(self, name, interval):
+        fetched_at = self.fetched_at.get(name)
+        due_at = time.time() if fetched_at is None else fetched_at + interval
+        return max(due_at, self.retry_at.get(name, 0))
+
+    def refresh_due(self):
+        for name, interval in self.intervals.items():
+            if interval > 0 and self.due_at(name, interval) <= time.time():
+                try:
+                    self.refresh(name)
+                except Exception as e:
+                    logger.warning('Refreshing %s list failed: %s' % (name, e))
+
+    def seconds_until_due(self):
+        now = time.time()
+        waits = [self.due_at(name, interval) - now
+            for name, interval in self.intervals.items() if interval > 0]
+        return max(min(waits or [60]), 1)
+
+class ListPrefetcher(threading.Thread):
+    def __init__(self, browse_lists):
+        super(ListPrefetcher, self).__init__(name='SubidyListPrefetcher')
+        self.daemon = True
+        self.browse_lists = browse_lists
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.browse_lists.refresh_due()
+            self.stopped.wait(self.browse_lists.seconds_until_due())
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,104 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Default time-to-live in seconds for each cacheable subsonic endpoint.
+# Endpoints missing from this table (and from the configured overrides)
+# are never cached, which keeps write calls like createPlaylist out of it.
+DEFAULT_TTLS = dict(
+    getIndexes=3600,
+    getArtists=3600,
+    getArtist=600,
+    getAlbum=600,
+    getSong=600,
+    getMusicDirectory=600,
+    getAlbumList2=300,
+    getGenres=3600,
+    getPlaylists=60,
+    getPlaylist=60,
+    search2=60,
+    search3=60,
+)
+
+def parse_ttls(entries):
+    ttls = {}
+    for entry in entries or ():
+        endpoint, _, ttl = entry.partition(':')
+        try:
+            ttls[endpoint.strip()] = int(ttl)
+        except ValueError:
+            logger.warning('Ignoring invalid cache ttl entry: %s' % entry)
+    return ttls
+
+def make_key(endpoint, args, kwargs):
+    return (endpoint, tuple(args), tuple(sorted(kwargs.items())))
+
+def key_mentions(key, value):
+    return value in key[1] or value in (v for k, v in key[2])
+
+class ResponseCache(object):
+    def __init__(self, max_size=1000, default_ttl=None, ttls=None):
+        # default_ttl replaces every value of DEFAULT_TTLS when it is set.
+        self.max_size = max_size
+        self.ttls = dict(DEFAULT_TTLS)
+        if default_ttl is not None:
+            self.ttls = dict((endpoint, default_ttl) for endpoint in DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl_for(self, endpoint):
+        if self.max_size <= 0:
+            return 0
+        return self.ttls.get(endpoint, 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # re-insert to mark the entry as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        ttl = self.ttl_for(key[0])
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        with self.lock:
+            if predicate is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def discard(self, endpoint, *args, **kwargs):
+        with self.lock:
+            self.entries.pop(make_key(endpoint, args, kwargs), None)
+
+    def invalidate_endpoints(self, *endpoints):
+        self.invalidate(lambda key: key[0] in endpoints)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                size=len(self.entries),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions)
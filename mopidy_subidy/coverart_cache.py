@@ -0,0 +1,118 @@
+import collections
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import mopidy_subidy
+
+logger = logging.getLogger(__name__)
+
+CachedImage = collections.namedtuple('CachedImage', ['digest', 'content_type', 'size', 'modified', 'path'])
+
+class CoverartCache(object):
+    # Images are stored content-addressed by their sha1 under `directory`,
+    # a small SQLite index maps cache keys (cover art id and size) to them.
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, digest TEXT, content_type TEXT, size INTEGER, modified REAL, accessed REAL)')
+        self.db.commit()
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT digest, content_type, size, modified FROM images WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            path = self.get_blob_path(row[0])
+            if not os.path.exists(path):
+                self.db.execute('DELETE FROM images WHERE key = ?', (key,))
+                self.db.commit()
+                return None
+            self.db.execute('UPDATE images SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+            return CachedImage(row[0], row[1], row[2], row[3], path)
+
+    def open_writer(self):
+        return CoverartWriter(self)
+
+    def put(self, key, data, content_type):
+        writer = self.open_writer()
+        writer.write(data)
+        return writer.commit(key, content_type)
+
+    def add(self, key, digest, content_type, size, tmp_path):
+        path = self.get_blob_path(digest)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(tmp_path, path)
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO images (key, digest, content_type, size, modified, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, digest, content_type, size, now, now))
+            self.db.commit()
+            self.evict()
+        return CachedImage(digest, content_type, size, now, path)
+
+    def evict(self):
+        total = self.db.execute('SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM images)').fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        for key, digest, size in self.db.execute('SELECT key, digest, size FROM images ORDER BY accessed').fetchall():
+            if total <= self.max_size:
+                break
+            self.db.execute('DELETE FROM images WHERE key = ?', (key,))
+            if self.db.execute('SELECT 1 FROM images WHERE digest = ?', (digest,)).fetchone() is None:
+                try:
+                    os.remove(self.get_blob_path(digest))
+                except OSError:
+                    pass
+                total -= size
+        self.db.commit()
+        logger.debug('Evicted cover art images, cache size is now %d bytes' % total)
+
+class CoverartWriter(object):
+    # Collects an image chunk by chunk in a temporary file while hashing it,
+    # so images can be cached while they are streamed to the client.
+    def __init__(self, cache):
+        self.cache = cache
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.directory)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.sha1.update(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def commit(self, key, content_type):
+        self.file.close()
+        return self.cache.add(key, self.sha1.hexdigest(), content_type, self.size, self.tmp_path)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+def get_coverart_cache_with_config(config):
+    max_size = config['subidy']['coverart_cache_size'] * 1024 * 1024
+    if max_size <= 0:
+        return None
+    directory = os.path.join(mopidy_subidy.SubidyExtension.get_cache_dir(config), 'coverart')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return CoverartCache(directory, max_size)
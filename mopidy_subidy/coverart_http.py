@@ -2,48 +2,174 @@ from __future__ import absolute_import, unicode_literals
 
 import os
 
+import calendar
+import datetime
+import email.utils
 import logging
 import concurrent.futures
 import tornado.web
 import tornado.gen
 import tornado.concurrent
-import requests
-from mopidy import httpclient
-from mopidy_subidy import subsonic_api
-import mopidy_subidy
+import tornado.iostream
+from mopidy_subidy import coverart_cache, subsonic_api
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 64 * 1024
+
+class ClientDisconnected(Exception):
+    pass
+
 class CoverartRequestHandler(tornado.web.RequestHandler):
     executor = concurrent.futures.ThreadPoolExecutor(10)
+    # Futures of the images being loaded into the cache right now, by cache
+    # key. Only touched on the IOLoop thread.
+    streams = {}
+    coalesced = 0
 
-    def initialize(self, config, subsonic_api):
-        self.proxy_formatted = httpclient.format_proxy(config['proxy'])
+    def initialize(self, config, subsonic_api, coverart_cache):
         self.subsonic_api = subsonic_api
+        self.coverart_cache = coverart_cache
+        self.max_age = config['subidy']['coverart_max_age']
+        self.client_closed = False
+
+    def on_connection_close(self):
+        self.client_closed = True
+
+    @tornado.concurrent.run_on_executor
+    def _get_cached_image(self, key):
+        return self.coverart_cache.get(key)
 
     @tornado.concurrent.run_on_executor
-    def _get_data(self, a_id): # from https://gist.github.com/methane/2185380#gistcomment-1301483
-        proxies = dict(http=self.proxy_formatted, https=self.proxy_formatted)
-        useragent = httpclient.format_user_agent('{name}/{ver}'.format(name=mopidy_subidy.SubidyExtension.dist_name, ver=mopidy_subidy.__version__))
-        censored_url = self.subsonic_api.get_censored_coverart_image_uri(a_id)
+    def _commit(self, writer, key, content_type):
+        return writer.commit(key, content_type)
+
+    @tornado.concurrent.run_on_executor
+    def _open(self, url):
+        return self.subsonic_api.transport.get(url, stream=True)
+
+    @tornado.concurrent.run_on_executor
+    def _read_chunk(self, chunks):
+        return next(chunks, None)
+
+    @tornado.gen.coroutine
+    def _stream(self, a_id, size, key):
+        # Forwards the image to the client chunk by chunk as it arrives,
+        # copying it into the cache on the way. The next chunk is only read
+        # once the client has taken the previous one, so a slow client
+        # holds up the download instead of buffering the whole image.
+        censored_url = self.subsonic_api.get_censored_coverart_image_uri(a_id, size)
         logger.debug("Loading cover art from subsonic with url: '%s'" % censored_url)
-        url = self.subsonic_api.get_coverart_image_uri(a_id)
         try:
-            fetched = requests.get(url, headers={'user-agent': useragent}, proxies=proxies)
-            return fetched
+            response = yield self._open(self.subsonic_api.get_coverart_image_uri(a_id, size))
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading cover art image.')
-            raise tornado.web.HTTPError()
+            raise tornado.web.HTTPError(502)
+        try:
+            content_type = response.headers.get('Content-Type', 'application/octet-stream')
+            # subsonic reports errors as a regular (non-image) response
+            if response.status_code != 200 or not content_type.startswith('image/'):
+                logger.warning('Subsonic did not return an image for cover art %s.' % a_id)
+                raise tornado.web.HTTPError(404)
+            self.set_header('Content-Type', content_type)
+            self.set_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+            if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+                self.set_header('Content-Length', response.headers['Content-Length'])
+            writer = self.coverart_cache.open_writer() if self.coverart_cache is not None else None
+            chunks = response.iter_content(CHUNK_SIZE)
+            try:
+                while True:
+                    chunk = yield self._read_chunk(chunks)
+                    if chunk is None:
+                        break
+                    if self.client_closed:
+                        raise ClientDisconnected()
+                    self.write(chunk)
+                    if writer is not None:
+                        writer.write(chunk)
+                    yield self.flush()
+            except Exception as e:
+                if writer is not None:
+                    writer.discard()
+                if self.client_closed or isinstance(e, tornado.iostream.StreamClosedError):
+                    logger.debug('Client went away while loading cover art %s.' % a_id)
+                    return
+                logger.warning('Connecting to subsonic failed when loading cover art image.')
+                raise tornado.web.HTTPError(502)
+            if writer is not None:
+                yield self._commit(writer, key, content_type)
+        finally:
+            response.close()
+
+    @tornado.gen.coroutine
+    def _stream_once(self, a_id, size, key):
+        stream = tornado.concurrent.Future()
+        if self.coverart_cache is not None and key not in self.streams:
+            self.streams[key] = stream
+        try:
+            yield self._stream(a_id, size, key)
+        finally:
+            if self.streams.get(key) is stream:
+                del self.streams[key]
+            stream.set_result(None)
+
+    @tornado.gen.coroutine
+    def _send_cached(self, image):
+        self.set_header('Content-Type', image.content_type)
+        self.set_header('Content-Length', image.size)
+        with open(image.path, 'rb') as f:
+            while not self.client_closed:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.write(chunk)
+                yield self.flush()
+
+    def _is_not_modified_since(self, modified):
+        since = self.request.headers.get('If-Modified-Since')
+        if not since or self.request.headers.get('If-None-Match'):
+            return False
+        parsed = email.utils.parsedate(since)
+        return parsed is not None and int(modified) <= calendar.timegm(parsed)
+
+    def _get_size(self):
+        size = self.get_argument('size', None)
+        if size is None:
+            return None
+        try:
+            return subsonic_api.snap_coverart_size(int(size), self.subsonic_api.coverart_sizes)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
 
     @tornado.gen.coroutine
     def get(self):
         a_id = self.get_argument('id')
-        fetched = yield self._get_data(a_id)
-        self.set_header('Content-Type', fetched.headers.get('content-type', 'application/octet-stream'))
-        self.write(fetched.content)
+        size = self._get_size()
+        key = a_id if size is None else '%s@%d' % (a_id, size)
+        image = None
+        if self.coverart_cache is not None:
+            image = yield self._get_cached_image(key)
+            if image is None and key in self.streams:
+                # Another request is loading this image already; wait for it
+                # to land in the cache instead of loading it a second time.
+                CoverartRequestHandler.coalesced += 1
+                logger.debug('Waiting for cover art %s being loaded, %d requests coalesced so far' % (key, self.coalesced))
+                yield self.streams[key]
+                image = yield self._get_cached_image(key)
+        if image is None:
+            yield self._stream_once(a_id, size, key)
+            return
+        self.set_header('Etag', '"%s"' % image.digest)
+        self.set_header('Last-Modified', datetime.datetime.utcfromtimestamp(int(image.modified)))
+        self.set_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+        if self.check_etag_header() or self._is_not_modified_since(image.modified):
+            self.set_status(304)
+            return
+        yield self._send_cached(image)
 
 def factory(config, core):
     sapi = subsonic_api.get_subsonic_api_with_config(config)
+    cache = coverart_cache.get_coverart_cache_with_config(config)
     return (
-        ('/cover_art', CoverartRequestHandler, dict(config=config, subsonic_api=sapi)),
+        ('/cover_art', CoverartRequestHandler, dict(config=config, subsonic_api=sapi, coverart_cache=cache)),
     )
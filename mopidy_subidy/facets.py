@@ -0,0 +1,93 @@
+import collections
+import logging
+import threading
+
+from mopidy_subidy import search_index
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('artist', 'albumartist', 'album', 'genre', 'date')
+
+def get_song_facets(song, album):
+    fields = search_index.get_song_fields(song, album)
+    return tuple(
+        u'%s' % (fields[field],) if fields[field] not in (None, '') else None
+        for field in FIELDS)
+
+class LibraryFacets(object):
+    # Distinct artist, albumartist, album, genre and date values of the
+    # library, kept per album so a changed album only updates its own
+    # contribution. Queries on other fields narrow the albums to scan
+    # through an index of normalized value -> album ids.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.album_facets = {}
+        self.counters = dict((field, collections.Counter()) for field in FIELDS)
+        self.albums_by_value = dict((field, collections.defaultdict(set)) for field in FIELDS)
+        self.genres = None
+        self.built = False
+
+    def build(self, songs, albums):
+        album_by_id = dict((album.get('id'), album) for album in albums)
+        songs_by_album = collections.defaultdict(list)
+        for song in songs:
+            songs_by_album[song.get('albumId')].append(song)
+        with self.lock:
+            for album_id, album_songs in songs_by_album.items():
+                self.set_album(album_id, album_songs, album_by_id.get(album_id))
+            self.built = True
+        logger.debug('Built library facets of %d albums' % len(songs_by_album))
+
+    def update_album(self, album_id, songs, album):
+        with self.lock:
+            self.set_album(album_id, songs, album)
+
+    def set_album(self, album_id, songs, album):
+        for facets in self.album_facets.pop(album_id, ()):
+            for field, value in zip(FIELDS, facets):
+                if value is not None:
+                    self.counters[field][value] -= 1
+                    if self.counters[field][value] <= 0:
+                        del self.counters[field][value]
+                    album_ids = self.albums_by_value[field].get(search_index.normalize(value))
+                    if album_ids is not None:
+                        album_ids.discard(album_id)
+                        if not album_ids:
+                            del self.albums_by_value[field][search_index.normalize(value)]
+        album_facets = [get_song_facets(song, album) for song in songs]
+        for facets in album_facets:
+            for field, value in zip(FIELDS, facets):
+                if value is not None:
+                    self.counters[field][value] += 1
+                    self.albums_by_value[field][search_index.normalize(value)].add(album_id)
+        if album_facets:
+            self.album_facets[album_id] = album_facets
+
+    def set_genres(self, genres):
+        with self.lock:
+            self.genres = sorted(genres, key=search_index.normalize)
+
+    def supports(self, field, query):
+        return self.built and field in FIELDS and all(key in FIELDS for key in query or {})
+
+    def distinct(self, field, query=None):
+        with self.lock:
+            if not query:
+                if field == 'genre' and self.genres is not None:
+                    return list(self.genres)
+                return sorted(self.counters[field], key=search_index.normalize)
+            album_ids = None
+            for key, values in query.items():
+                for value in values:
+                    matches = self.albums_by_value[key].get(search_index.normalize(value), set())
+                    album_ids = set(matches) if album_ids is None else album_ids & matches
+            wanted = [(FIELDS.index(key), [search_index.normalize(value) for value in values]) for key, values in query.items()]
+            field_index = FIELDS.index(field)
+            result = set()
+            for album_id in album_ids or ():
+                for facets in self.album_facets.get(album_id, ()):
+                    if facets[field_index] is None:
+                        continue
+                    if all(facets[i] is not None and all(search_index.normalize(facets[i]) == value for value in values) for i, values in wanted):
+                        result.add(facets[field_index])
+            return sorted(result, key=search_index.normalize)
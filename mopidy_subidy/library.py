@@ -1,7 +1,9 @@
 from mopidy import backend, models
 from mopidy.models import Ref, SearchResult
-from mopidy_subidy import uri
+from mopidy_subidy import search_index, uri
 
+import collections
+import itertools
 import logging
 logger = logging.getLogger(__name__)
 
@@ -12,6 +14,12 @@ class SubidyLibraryProvider(backend.LibraryProvider):
             dict(id="artists", name="Artists"),
             dict(id="albums", name="Albums"),
             dict(id="rootdirs", name="Directories"),
+            dict(id="newest", name="Newest albums"),
+            dict(id="recent", name="Recently played"),
+            dict(id="frequent", name="Most played"),
+            dict(id="starred", name="Starred"),
+            dict(id="random", name="Random songs"),
+            dict(id="genres", name="Genres"),
         ]
         # Create a dict with the keys being the `id`s in `vdir_templates`
         # and the values being objects containing the vdir `id`,
@@ -39,6 +47,8 @@ class SubidyLibraryProvider(backend.LibraryProvider):
     def __init__(self, *args, **kwargs):
         super(SubidyLibraryProvider, self).__init__(*args, **kwargs)
         self.subsonic_api = self.backend.subsonic_api
+        self.album_bucket_threshold = self.backend.album_bucket_threshold
+        self.browse_lists = self.backend.browse_lists
 
     def browse_songs(self, album_id):
         return self.subsonic_api.get_songs_as_refs(album_id)
@@ -46,6 +56,17 @@ class SubidyLibraryProvider(backend.LibraryProvider):
     def browse_albums(self, artist_id=None):
         return self.subsonic_api.get_albums_as_refs(artist_id)
 
+    def browse_all_albums(self):
+        # Large libraries are split up by initial instead of being sent as
+        # one huge list.
+        refs = self.browse_albums()
+        if len(refs) <= self.album_bucket_threshold:
+            return refs
+        return self.subsonic_api.get_album_buckets_as_refs()
+
+    def browse_album_bucket(self, bucket):
+        return self.subsonic_api.get_album_bucket_as_refs(bucket)
+
     def browse_artists(self):
         return self.subsonic_api.get_artists_as_refs()
 
@@ -75,8 +96,14 @@ class SubidyLibraryProvider(backend.LibraryProvider):
         return self.subsonic_api.get_playlist_as_playlist(playlist_id).tracks
 
     def browse(self, browse_uri):
+        # A slow server response holds the backend actor for browse_timeout
+        # at most.
+        refs = self.subsonic_api.call_with_deadline(self.browse_blocking, browse_uri)
+        return refs if refs is not None else []
+
+    def browse_blocking(self, browse_uri):
         if browse_uri == uri.get_vdir_uri('root'):
-            root_vdir_names = ["rootdirs", "artists", "albums"]
+            root_vdir_names = ["rootdirs", "artists", "albums", "newest", "recent", "frequent", "starred", "random", "genres"]
             root_vdirs = [self._vdirs[vdir_name] for vdir_name in root_vdir_names]
             sorted_root_vdirs = sorted(root_vdirs, key=lambda vdir: vdir["name"])
             return [self._raw_vdir_to_ref(vdir) for vdir in sorted_root_vdirs]
@@ -85,40 +112,74 @@ class SubidyLibraryProvider(backend.LibraryProvider):
         elif browse_uri == uri.get_vdir_uri("artists"):
             return self.browse_artists()
         elif browse_uri == uri.get_vdir_uri("albums"):
-            return self.browse_albums()
+            return self.browse_all_albums()
         else:
-            uri_type = uri.get_type(browse_uri)
-            if uri_type == uri.DIRECTORY:
-                return self.browse_diritems(uri.get_directory_id(browse_uri))
+            uri_type, uri_id = uri.parse(browse_uri)
+            vdir_id = (uri_id or '') if uri_type == uri.VDIR else ''
+            if vdir_id in self.browse_lists:
+                return self.browse_lists.get(vdir_id)
+            elif vdir_id.startswith('albums:'):
+                return self.browse_album_bucket(vdir_id[len('albums:'):])
+            elif vdir_id.startswith('genres:'):
+                return self.subsonic_api.get_genre_albums_as_refs(vdir_id[len('genres:'):])
+            elif uri_type == uri.DIRECTORY:
+                return self.browse_diritems(uri_id)
             elif uri_type == uri.ARTIST:
-                return self.browse_albums(uri.get_artist_id(browse_uri))
+                return self.browse_albums(uri_id)
             elif uri_type == uri.ALBUM:
-                return self.browse_songs(uri.get_album_id(browse_uri))
+                return self.browse_songs(uri_id)
             else:
                 return []
 
     def lookup_one(self, lookup_uri):
-        type = uri.get_type(lookup_uri)
+        type, item_id = uri.parse(lookup_uri)
         if type == uri.ARTIST:
-            return self.lookup_artist(uri.get_artist_id(lookup_uri))
+            return self.lookup_artist(item_id)
         if type == uri.ALBUM:
-            return self.lookup_album(uri.get_album_id(lookup_uri))
+            return self.lookup_album(item_id)
         if type == uri.DIRECTORY:
-            return self.lookup_directory(uri.get_directory_id(lookup_uri))
+            return self.lookup_directory(item_id)
         if type == uri.SONG:
-            return self.lookup_song(uri.get_song_id(lookup_uri))
+            return self.lookup_song(item_id)
         if type == uri.PLAYLIST:
-            return self.lookup_playlist(uri.get_playlist_id(lookup_uri))
+            return self.lookup_playlist(item_id)
+
+    def lookup_many(self, lookup_uris):
+        unique_uris = list(collections.OrderedDict.fromkeys(lookup_uris))
+        uris_by_type = collections.defaultdict(list)
+        for lookup_uri in unique_uris:
+            uris_by_type[uri.get_type(lookup_uri)].append(lookup_uri)
+        tracks_by_song_id, tracks_by_album_id = self.subsonic_api.get_tracks_by_ids(
+            song_ids=[uri.get_song_id(song_uri) for song_uri in uris_by_type[uri.SONG]],
+            album_ids=[uri.get_album_id(album_uri) for album_uri in uris_by_type[uri.ALBUM]])
+        results = {}
+        for song_uri in uris_by_type[uri.SONG]:
+            track = tracks_by_song_id.get(uri.get_song_id(song_uri))
+            results[song_uri] = [track] if track is not None else []
+        for album_uri in uris_by_type[uri.ALBUM]:
+            results[album_uri] = tracks_by_album_id.get(uri.get_album_id(album_uri)) or []
+        for lookup_uri in unique_uris:
+            if lookup_uri not in results:
+                results[lookup_uri] = self.lookup_one(lookup_uri)
+        return results
 
     def lookup(self, uri=None, uris=None):
         if uris is not None:
-            return dict((uri, self.lookup_one(uri)) for uri in uris)
+            return self.lookup_many(uris)
         if uri is not None:
             return self.lookup_one(uri)
         return None
 
-    def refresh(self, uri):
-        pass
+    def refresh(self, refresh_uri=None):
+        logger.debug('Invalidating response cache for %s, cache stats: %s, connection stats: %s, coalesced requests: %s' % (
+            refresh_uri, self.subsonic_api.cache.stats(), self.subsonic_api.transport.stats(), self.subsonic_api.single_flight.stats()))
+        self.subsonic_api.invalidate_cache(refresh_uri)
+        if refresh_uri is None or uri.get_type(refresh_uri) == uri.VDIR:
+            self.browse_lists.invalidate()
+            # The root browses come from the snapshot, which only the
+            # refresher brings up to date.
+            if self.backend.snapshot_refresher is not None:
+                self.backend.snapshot_refresher.sync_now()
 
     def search_uri_iter(self, lookup_uri, include_self=True):
         type = uri.get_type(lookup_uri)
@@ -164,18 +225,29 @@ class SubidyLibraryProvider(backend.LibraryProvider):
         return dict(artists=artists, albums=albums, tracks=tracks)
 
     def search_by_artist_album_and_track(self, artist_name, album_name, track_name):
-        tracks = self.search_by_artist_and_album(artist_name, album_name)
-        track = next(item for item in tracks.tracks if track_name in item.name)
-        return SearchResult(tracks=[track])
+        tracks = self.search_by_artist_and_album(artist_name, album_name).tracks
+        track_key = search_index.normalize(track_name)
+        return SearchResult(tracks=[track for track in tracks if track_key in search_index.normalize(track.name or '')])
 
     def search_by_artist_and_album(self, artist_name, album_name):
-        artists = self.subsonic_api.get_raw_artists()
-        artist = next(item for item in artists if artist_name in item.get('name'))
-        albums = self.subsonic_api.get_raw_albums(artist.get('id'))
-        album = next(item for item in albums if album_name in item.get('title'))
-        return SearchResult(tracks=self.subsonic_api.get_songs_as_tracks(album.get('id')))
+        artists, albums = self.subsonic_api.find_raw_artists_and_albums_by_name(artist_name, album_name)
+        album_ids = [album.get('id') for album in albums]
+        tracks_by_album_id = self.subsonic_api.get_tracks_by_ids(album_ids=album_ids)[1]
+        return SearchResult(
+            artists=[self.subsonic_api.raw_artist_to_artist(artist) for artist in artists],
+            albums=[self.subsonic_api.raw_album_to_album(album) for album in albums],
+            tracks=[track for album_id in album_ids for track in tracks_by_album_id[album_id]])
 
     def get_distinct(self, field, query):
+        library_facets = self.subsonic_api.facets
+        if library_facets is not None and library_facets.supports(field, query):
+            return library_facets.distinct(field, query)
+        distinct_kinds = dict(artist='artist', album='album', track='song', title='song')
+        if field in distinct_kinds and query and len(query) == 1 and ('any' in query or field in query):
+            search_query = (query.get('any') or query.get(field))[0]
+            return list(itertools.islice(
+                self.subsonic_api.find_distinct_names_iter(search_query, distinct_kinds[field]),
+                self.subsonic_api.search_max_results))
         search_result = self.search(query)
         if not search_result:
             return []
@@ -189,6 +261,9 @@ class SubidyLibraryProvider(backend.LibraryProvider):
             return [artist.name for artist in search_result.artists]
 
     def search(self, query=None, uris=None, exact=False):
+        local_result = self.subsonic_api.find_local_as_search_result(query or {}, exact)
+        if local_result is not None:
+            return local_result
         if 'artist' in query and 'album' in query and 'track_name' in query:
             return self.search_by_artist_album_and_track(query.get('artist')[0], query.get('album')[0], query.get('track_name')[0])
         if 'artist' in query and 'album' in query:
@@ -208,25 +283,16 @@ class SubidyLibraryProvider(backend.LibraryProvider):
         return SearchResult(artists=self.subsonic_api.get_artists_as_artists())
 
     def get_coverart_image(self, a_uri):
-        utype = uri.get_type(a_uri)
-        if utype == uri.ARTIST:
-            coverart_item_id = self.subsonic_api.coverart_item_id_by_artist_id(uri.get_artist_id(a_uri))
-        elif utype == uri.ALBUM:
-            coverart_item_id = self.subsonic_api.coverart_item_id_by_album_id(uri.get_album_id(a_uri))
-        elif utype == uri.SONG:
-            coverart_item_id = self.subsonic_api.coverart_item_id_by_song_id(uri.get_song_id(a_uri))
-        elif utype == uri.DIRECTORY:
-            coverart_item_id = self.subsonic_api.coverart_item_id_by_directory_id(uri.get_directory_id(a_uri))
-        else:
-            return []
-        if coverart_item_id is not None:
-            image_uri = self.subsonic_api.get_coverart_image_by_id(coverart_item_id)
-            if image_uri is not None:
-                return [image_uri]
-            else:
-                return []
-        else:
-            return []
+        return self.get_images([a_uri])[a_uri]
 
     def get_images(self, uris):
-        return dict((a_uri, self.get_coverart_image(a_uri)) for a_uri in uris)
+        items = dict((a_uri, tuple(uri.parse(a_uri))) for a_uri in uris)
+        coverart_item_ids = self.subsonic_api.get_coverart_item_ids(items.values())
+        images = {}
+        for a_uri in uris:
+            coverart_item_id = coverart_item_ids.get(items[a_uri])
+            if coverart_item_id is not None:
+                images[a_uri] = self.subsonic_api.get_coverart_images_by_id(coverart_item_id)
+            else:
+                images[a_uri] = []
+        return images
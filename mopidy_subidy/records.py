@@ -0,0 +1,108 @@
+INTERN_TABLE_SIZE = 200000
+
+# Values repeated across many records, shared instead of kept once per record.
+INTERNED_FIELDS = frozenset(('artist', 'artistId', 'album', 'albumId', 'genre', 'parent'))
+
+interned = {}
+
+def intern_string(value):
+    # The builtin intern() only takes byte strings on python 2.
+    interned_value = interned.get(value)
+    if interned_value is None:
+        if len(interned) >= INTERN_TABLE_SIZE:
+            interned.clear()
+        interned[value] = interned_value = value
+    return interned_value
+
+class Record(object):
+    # Keeps only the fields subidy uses out of a subsonic response entry.
+    # get(), [] and `in` behave like on the dict it was made from, so code
+    # handling responses works on records and dicts alike.
+    __slots__ = ()
+    field_set = frozenset()
+
+    def __init__(self, data):
+        get = data.get
+        for field in self.__slots__:
+            value = get(field)
+            if value is not None and field in INTERNED_FIELDS:
+                value = intern_string(value)
+            setattr(self, field, value)
+
+    def get(self, name, default=None):
+        if name not in self.field_set:
+            return default
+        value = getattr(self, name)
+        return default if value is None else value
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__ if getattr(self, field) is not None)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.to_dict())
+
+SONG_FIELDS = (
+    'id', 'parent', 'isDir', 'title', 'album', 'albumId', 'artist', 'artistId',
+    'track', 'discNumber', 'year', 'genre', 'duration', 'bitRate', 'coverArt', 'created',
+    'comment', 'musicBrainzId', 'albumArtists')
+ALBUM_FIELDS = (
+    'id', 'parent', 'isDir', 'name', 'title', 'artist', 'artistId', 'songCount',
+    'duration', 'year', 'genre', 'coverArt', 'created', 'musicBrainzId')
+ARTIST_FIELDS = ('id', 'name', 'sortName', 'coverArt', 'albumCount', 'musicBrainzId')
+DIRECTORY_FIELDS = ('id', 'parent', 'isDir', 'title', 'name', 'artist', 'album', 'coverArt', 'created')
+
+class SongRecord(Record):
+    __slots__ = SONG_FIELDS
+    field_set = frozenset(SONG_FIELDS)
+
+class AlbumRecord(Record):
+    __slots__ = ALBUM_FIELDS
+    field_set = frozenset(ALBUM_FIELDS)
+
+class ArtistRecord(Record):
+    __slots__ = ARTIST_FIELDS
+    field_set = frozenset(ARTIST_FIELDS)
+
+class DirectoryRecord(Record):
+    __slots__ = DIRECTORY_FIELDS
+    field_set = frozenset(DIRECTORY_FIELDS)
+
+# Response keys holding songs, albums, artists or directory entries.
+RECORD_TYPES = dict(
+    song=SongRecord,
+    entry=SongRecord,
+    child=SongRecord,
+    album=AlbumRecord,
+    artist=ArtistRecord,
+)
+
+def make_record(key, data):
+    if key == 'child' and data.get('isDir'):
+        return DirectoryRecord(data)
+    return RECORD_TYPES[key](data)
+
+def compact(value, key=None):
+    # Turns the entries of a parsed response into records. Dicts holding
+    # other entries (like the album of getAlbum with its songs) stay dicts.
+    if isinstance(value, dict):
+        if key in RECORD_TYPES and not any(isinstance(value.get(k), (list, dict)) for k in RECORD_TYPES):
+            return make_record(key, value)
+        return dict((k, compact(v, k)) for k, v in value.items())
+    if isinstance(value, list):
+        return [compact(item, key) for item in value]
+    return value
+
+def to_json(value):
+    # json.dumps default= hook for records.
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError('%r is not JSON serializable' % (value,))
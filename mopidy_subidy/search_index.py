@@ -0,0 +1,194 @@
+import bisect
+import heapq
+import itertools
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('artist', 'albumartist', 'album', 'track_name', 'genre', 'date')
+token_regex = re.compile(r'\w+', re.UNICODE)
+
+def normalize(text):
+    # Case-folded and with accents stripped, so "Bjork" also matches "Bj\u00f6rk".
+    decomposed = unicodedata.normalize('NFKD', (u'%s' % (text,)).lower())
+    return u''.join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokenize(text):
+    return token_regex.findall(normalize(text))
+
+def get_song_fields(song, album):
+    return dict(
+        artist=song.get('artist'),
+        albumartist=(album or {}).get('artist') or song.get('artist'),
+        album=song.get('album'),
+        track_name=song.get('title'),
+        genre=song.get('genre'),
+        date=song.get('year'))
+
+class SearchIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.songs = []
+        self.tokens = {}
+        self.sorted_tokens = {}
+        self.values = {}
+        self.built_at = None
+        self.complete = False
+
+    def build(self, songs, albums, complete=True):
+        start = time.time()
+        album_by_id = dict((album.get('id'), album) for album in albums)
+        song_list = []
+        tokens = dict((field, {}) for field in FIELDS + ('any',))
+        values = dict((field, {}) for field in FIELDS)
+        for song in songs:
+            position = len(song_list)
+            song_list.append(song)
+            fields = get_song_fields(song, album_by_id.get(song.get('albumId')))
+            for field, value in fields.items():
+                if value is None or value == '':
+                    continue
+                values[field].setdefault(normalize(value), set()).add(position)
+                for token in tokenize(value):
+                    tokens[field].setdefault(token, set()).add(position)
+                    tokens['any'].setdefault(token, set()).add(position)
+        sorted_tokens = dict((field, sorted(field_tokens)) for field, field_tokens in tokens.items())
+        with self.lock:
+            self.songs = song_list
+            self.tokens = tokens
+            self.sorted_tokens = sorted_tokens
+            self.values = values
+            self.built_at = time.time()
+            self.complete = complete
+        logger.info('Built local search index of %d songs in %.1fs' % (len(song_list), self.built_at - start))
+
+    def touch(self):
+        # A sync that changed nothing keeps the index fresh without a rebuild.
+        with self.lock:
+            self.built_at = time.time()
+
+    def is_fresh(self, max_age):
+        return self.complete and self.built_at is not None and time.time() - self.built_at <= max_age
+
+    def supports(self, query):
+        return bool(query) and all(field in FIELDS or field == 'any' for field in query)
+
+    def match_prefix(self, field, token, limit=None):
+        # Stops at the limit-th match, a short prefix can match most of the
+        # library.
+        field_tokens = self.tokens[field]
+        sorted_tokens = self.sorted_tokens[field]
+        matches = set()
+        i = bisect.bisect_left(sorted_tokens, token)
+        while i < len(sorted_tokens) and sorted_tokens[i].startswith(token):
+            if limit is None:
+                matches.update(field_tokens[sorted_tokens[i]])
+            else:
+                matches.update(itertools.islice(field_tokens[sorted_tokens[i]], limit - len(matches)))
+                if len(matches) >= limit:
+                    break
+            i += 1
+        return matches
+
+    def match_value(self, field, value, exact):
+        if exact:
+            if field == 'any':
+                matches = set()
+                for field_values in self.values.values():
+                    matches.update(field_values.get(normalize(value), ()))
+                return matches
+            return set(self.values[field].get(normalize(value), ()))
+        matches = None
+        for token in tokenize(value):
+            token_matches = self.match_prefix(field, token)
+            matches = token_matches if matches is None else matches & token_matches
+            if not matches:
+                return set()
+        return matches if matches is not None else set()
+
+    def search(self, query, exact=False, max_results=None):
+        # Every value of every field has to match (AND); a value matches
+        # when each of its words is a prefix of a word in the field, or the
+        # whole field when exact is set. Songs come back in index order, at
+        # most max_results of them when it is set.
+        values = [(field, value) for field, field_values in query.items() for value in field_values]
+        if len(values) == 1 and not exact and len(tokenize(values[0][1])) == 1:
+            # A single word is not intersected with anything, so matching
+            # can stop once there are enough results.
+            field, value = values[0]
+            with self.lock:
+                matches = self.match_prefix(field, tokenize(value)[0], max_results)
+                return [self.songs[position] for position in heapq.nsmallest(max_results or len(matches), matches)]
+        with self.lock:
+            matches = None
+            for field, field_values in query.items():
+                for value in field_values:
+                    value_matches = self.match_value(field, value, exact)
+                    matches = value_matches if matches is None else matches & value_matches
+                    if not matches:
+                        return []
+            if max_results is not None and len(matches or ()) > max_results:
+                positions = heapq.nsmallest(max_results, matches)
+            else:
+                positions = sorted(matches or ())
+            return [self.songs[position] for position in positions]
+
+class NameIndex(object):
+    # Artists and albums by normalized name, for artist/album/track queries.
+    # Multiple matches keep the natural (string_nums_nocase_sort_key) order.
+    def __init__(self, sort_key):
+        self.sort_key = sort_key
+        self.lock = threading.Lock()
+        self.artists = {}
+        self.albums = {}
+        self.albums_by_artist_id = {}
+        self.built = False
+
+    def build(self, artists, albums):
+        artists_by_name = {}
+        for artist in artists:
+            artists_by_name.setdefault(normalize(artist.get('name') or ''), []).append(artist)
+        albums_by_name = {}
+        albums_by_artist_id = {}
+        for album in albums:
+            albums_by_name.setdefault(normalize(album.get('name') or ''), []).append(album)
+            albums_by_artist_id.setdefault(album.get('artistId'), []).append(album)
+        for index in (artists_by_name, albums_by_name, albums_by_artist_id):
+            for items in index.values():
+                items.sort(key=lambda item: self.sort_key(item.get('name') or ''))
+        with self.lock:
+            self.artists = artists_by_name
+            self.albums = albums_by_name
+            self.albums_by_artist_id = albums_by_artist_id
+            self.built = True
+        logger.debug('Built name index of %d artists and %d albums' % (len(artists), len(albums)))
+
+    def lookup(self, index, name):
+        # Exact (normalized) names first, substring matches otherwise.
+        key = normalize(name)
+        with self.lock:
+            if key in index:
+                return list(index[key])
+            matches = [item for name_key, items in index.items() if key in name_key for item in items]
+        return sorted(matches, key=lambda item: self.sort_key(item.get('name') or ''))
+
+    def find_artists(self, name):
+        return self.lookup(self.artists, name)
+
+    def find_albums(self, name, artist_ids=None):
+        if artist_ids is None:
+            return self.lookup(self.albums, name)
+        # Only the albums of the given artists are matched, by exact
+        # (normalized) name first and substring otherwise.
+        key = normalize(name)
+        with self.lock:
+            albums = [(normalize(album.get('name') or ''), album)
+                for artist_id in artist_ids for album in self.albums_by_artist_id.get(artist_id, ())]
+        matches = [album for name_key, album in albums if name_key == key]
+        if not matches:
+            matches = [album for name_key, album in albums if key in name_key]
+        return sorted(matches, key=lambda album: self.sort_key(album.get('name') or ''))
@@ -0,0 +1,48 @@
+import concurrent.futures
+import threading
+
+class SingleFlight(object):
+    # Concurrent calls for the same key share one execution: the first
+    # caller runs it, later ones wait for and get the same result (or
+    # exception) instead of sending an identical request.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = concurrent.futures.Future()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return call.result()
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(key)
+            call.set_exception(e)
+            raise
+        self.finish(key)
+        call.set_result(result)
+        return result
+
+    def finish(self, key):
+        with self.lock:
+            del self.calls[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(executed=self.executed, coalesced=self.coalesced, in_flight=len(self.calls))
+
+_shared_single_flight = SingleFlight()
+
+def get_shared_single_flight():
+    # Shared by the backend and the cover art handler, which each have
+    # their own SubsonicApi.
+    return _shared_single_flight
@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from mopidy_subidy import records
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+INDEXES = ('artists', 'albums', 'rootdirs')
+# Seconds between syncs while some albums' songs are not in the snapshot
+# yet, so the backfill doesn't take a snapshot_refresh_interval per batch.
+BACKFILL_INTERVAL = 60
+
+INDEX_RECORDS = dict(artists=records.ArtistRecord, albums=records.AlbumRecord, rootdirs=records.ArtistRecord)
+
+class LibrarySnapshot(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = None
+        self.indexes = {}
+        # Bumped on every write, so readers can tell whether anything changed.
+        self.version = 0
+
+    def connect(self):
+        with self.lock:
+            if self.db is not None:
+                return self.db
+            logger.debug('Opening library snapshot at %s' % self.path)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                for table in INDEXES + ('songs', 'synced_albums', 'meta'):
+                    db.execute('DROP TABLE IF EXISTS %s' % table)
+                db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            for table in INDEXES:
+                db.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, position INTEGER, data TEXT)' % table)
+            db.execute('CREATE TABLE IF NOT EXISTS songs (id TEXT PRIMARY KEY, album_id TEXT, data TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS songs_album_id ON songs (album_id)')
+            # Albums whose songs were fetched, empty ones included, and the
+            # ones whose getAlbum failed (failed = 1, retried by the backfill).
+            db.execute('CREATE TABLE IF NOT EXISTS synced_albums (album_id TEXT PRIMARY KEY, failed INTEGER)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            db.commit()
+            self.db = db
+            return db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def get(self, index):
+        # Indexes are loaded from disk on first use and then served from memory.
+        with self.lock:
+            items = self.indexes.get(index)
+            if items is None:
+                rows = self.connect().execute('SELECT data FROM %s ORDER BY position' % index)
+                items = [INDEX_RECORDS[index](json.loads(row[0])) for row in rows]
+                self.indexes[index] = items
+            return items
+
+    def update(self, index, items):
+        with self.lock:
+            db = self.connect()
+            ids = set(item.get('id') for item in items)
+            stale = [row[0] for row in db.execute('SELECT id FROM %s' % index) if row[0] not in ids]
+            db.executemany('DELETE FROM %s WHERE id = ?' % index, ((item_id,) for item_id in stale))
+            db.executemany(
+                'INSERT OR REPLACE INTO %s (id, position, data) VALUES (?, ?, ?)' % index,
+                ((item.get('id'), position, json.dumps(item, default=records.to_json)) for position, item in enumerate(items)))
+            db.commit()
+            self.indexes[index] = list(items)
+            self.version += 1
+            logger.debug('Updated %s snapshot: %d entries, %d removed' % (index, len(items), len(stale)))
+
+    def get_songs(self, album_id):
+        with self.lock:
+            rows = self.connect().execute('SELECT data FROM songs WHERE album_id = ?', (album_id,))
+            return [records.SongRecord(json.loads(row[0])) for row in rows]
+
+    def get_song(self, song_id):
+        with self.lock:
+            row = self.connect().execute('SELECT data FROM songs WHERE id = ?', (song_id,)).fetchone()
+            return records.SongRecord(json.loads(row[0])) if row is not None else None
+
+    def get_all_songs(self):
+        # Only reading the rows holds the lock, decoding them can take a
+        # while on a large library.
+        with self.lock:
+            rows = self.connect().execute('SELECT data FROM songs').fetchall()
+        return [records.SongRecord(json.loads(row[0])) for row in rows]
+
+    def get_synced_album_ids(self):
+        with self.lock:
+            return set(row[0] for row in self.connect().execute('SELECT album_id FROM synced_albums'))
+
+    def get_failed_album_ids(self):
+        with self.lock:
+            return set(row[0] for row in self.connect().execute('SELECT album_id FROM synced_albums WHERE failed = 1'))
+
+    def update_songs(self, album_id, songs):
+        with self.lock:
+            db = self.connect()
+            db.execute('DELETE FROM songs WHERE album_id = ?', (album_id,))
+            db.executemany(
+                'INSERT OR REPLACE INTO songs (id, album_id, data) VALUES (?, ?, ?)',
+                ((song.get('id'), album_id, json.dumps(song, default=records.to_json)) for song in songs))
+            db.execute('INSERT OR REPLACE INTO synced_albums (album_id, failed) VALUES (?, 0)', (album_id,))
+            db.commit()
+            self.version += 1
+
+    def mark_albums_failed(self, album_ids):
+        # Counted as synced so they don't hold up the local search and the
+        # facets; songs fetched earlier are kept.
+        with self.lock:
+            db = self.connect()
+            changes = db.total_changes
+            db.executemany(
+                'INSERT OR IGNORE INTO synced_albums (album_id, failed) VALUES (?, 1)',
+                ((album_id,) for album_id in album_ids))
+            db.commit()
+            if db.total_changes != changes:
+                self.version += 1
+
+    def prune_songs(self, album_ids):
+        # Drops the songs of albums that are not in album_ids any more and
+        # returns the ids of those albums.
+        with self.lock:
+            db = self.connect()
+            stale = [row[0] for row in db.execute('SELECT album_id FROM synced_albums') if row[0] not in album_ids]
+            db.executemany('DELETE FROM songs WHERE album_id = ?', ((album_id,) for album_id in stale))
+            db.executemany('DELETE FROM synced_albums WHERE album_id = ?', ((album_id,) for album_id in stale))
+            db.commit()
+            if stale:
+                self.version += 1
+            return stale
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+            return json.loads(row[0]) if row is not None else default
+
+    def set_meta(self, key, value):
+        with self.lock:
+            db = self.connect()
+            db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+            db.commit()
+
+    def observe(self, endpoint, response):
+        # Called with every fresh server response, so albums the user opens
+        # end up in the songs index without extra requests.
+        if endpoint == 'getAlbum':
+            album = response.get('album') or {}
+            if album.get('id') is not None:
+                self.update_songs(album.get('id'), album.get('song') or [])
+
+class SnapshotRefresher(threading.Thread):
+    def __init__(self, subsonic_api, interval):
+        super(SnapshotRefresher, self).__init__(name='SubidySnapshotRefresher')
+        self.daemon = True
+        self.subsonic_api = subsonic_api
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.sync_requested = threading.Event()
+
+    def run(self):
+        try:
+            for index in INDEXES:
+                self.subsonic_api.snapshot.get(index)
+        except Exception as e:
+            logger.warning('Loading library snapshot failed: %s' % e)
+        while not self.stopped.is_set():
+            complete = True
+            try:
+                complete = self.subsonic_api.refresh_snapshot()
+            except Exception as e:
+                logger.warning('Refreshing library snapshot failed: %s' % e)
+            self.sync_requested.wait(self.interval if complete else min(self.interval, BACKFILL_INTERVAL))
+            self.sync_requested.clear()
+
+    def sync_now(self):
+        # Wakes the refresher for a sync before the interval is up, a
+        # request during a sync gets another one right after it.
+        self.sync_requested.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.sync_requested.set()
+
+def get_snapshot_path(data_dir):
+    return os.path.join(data_dir, 'library.db')
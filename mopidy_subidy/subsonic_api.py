@@ -3,12 +3,16 @@ from urllib import urlencode
 import libsonic
 import logging
 import itertools
+import collections
+import concurrent.futures
+import calendar
+import time
 import requests
 import urllib
 import re
 from mopidy.models import Track, Album, Artist, Playlist, Ref, SearchResult, Image
 import mopidy_subidy
-from mopidy_subidy import uri
+from mopidy_subidy import cache, facets, records, search_index, singleflight, snapshot, sync, transport, uri
 
 logger = logging.getLogger(__name__)
 
@@ -21,23 +25,86 @@ MAX_LIST_RESULTS = 500
 
 ref_sort_key = lambda ref: ref.name
 
+SORT_KEY_CACHE_SIZE = 50000
+
+digits_regex = re.compile(r'(\d+)')
+number_regex = re.compile(r'\s*(\d+)')
+
+sort_keys = {}
+
+def pad_number(match):
+    return '\x01%020d' % int(match.group(1))
+
 def string_nums_nocase_sort_key(s):
-    segments = []
-    for substr in re.split(r'(\d+)', s):
-        if substr.isdigit():
-            seg = int(substr)
-        else:
-            seg = substr.lower()
-        segments.append(seg)
-    return segments
+    # Natural sort key as a plain string: digit runs become zero padded
+    # numbers behind a low marker character, so comparing keys is a single
+    # string comparison. Keys are memoized as the same names get sorted on
+    # every browse.
+    key = sort_keys.get(s)
+    if key is None:
+        key = digits_regex.sub(pad_number, s.lower())
+        if len(sort_keys) >= SORT_KEY_CACHE_SIZE:
+            sort_keys.clear()
+        sort_keys[s] = key
+    return key
+
+MODEL_CACHE_SIZE = 20000
+
+COVERART_ID_CACHE_SIZE = 100000
+
+shared_models = {}
+
+def shared_model(model, **fields):
+    # Mopidy models are immutable, so every track of an album can share
+    # one Album and Artist instance instead of building its own.
+    key = (model, tuple(sorted(fields.items())))
+    instance = shared_models.get(key)
+    if instance is None:
+        if len(shared_models) >= MODEL_CACHE_SIZE:
+            shared_models.clear()
+        shared_models[key] = instance = model(**fields)
+    return instance
+
+def format_year(value):
+    year = parse_number(value)
+    return '%04d' % year if year else None
+
+def parse_timestamp(value):
+    # Subsonic dates look like 2017-03-01T10:00:00.000Z; mopidy wants ms.
+    try:
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')) * 1000
+    except (TypeError, ValueError):
+        return None
+
+def parse_number(value, default=None):
+    # Tags like "3/12" still give their leading number, junk gives default.
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        match = number_regex.match(u'%s' % value) if value is not None else None
+        return int(match.group(1)) if match is not None else default
+
+def name_sort_key(item):
+    return string_nums_nocase_sort_key(item.get('name') or item.get('title') or '')
 
 def diritem_sort_key(item):
-    isdir = item['isDir']
-    if isdir:
-        key = string_nums_nocase_sort_key(item['title'])
-    else:
-        key = int(item.get('track', 1))
-    return (isdir, key)
+    # Songs first ordered by disc and track number, then directories by
+    # name; sorted() is stable so ties keep the server order.
+    if item.get('isDir'):
+        return (True, string_nums_nocase_sort_key(item.get('title') or ''))
+    return (False, (parse_number(item.get('discNumber'), 1), parse_number(item.get('track'), 1)))
+
+def get_album_bucket(album):
+    initial = search_index.normalize(album.get('name') or '')[:1].upper()
+    return initial if initial.isalpha() else '#'
+
+def snap_coverart_size(size, sizes):
+    # Returns the smallest configured size fitting `size`, or None (the
+    # original image) when it is larger than all of them.
+    for bucket in sorted(sizes):
+        if size <= bucket:
+            return bucket
+    return None
 
 def get_subsonic_api_with_config(config):
     subidy_config = config['subidy']
@@ -47,12 +114,32 @@ def get_subsonic_api_with_config(config):
         password=subidy_config['password'],
         app_name=mopidy_subidy.SubidyExtension.dist_name,
         legacy_auth=subidy_config['legacy_auth'],
-        api_version=subidy_config['api_version'])
+        api_version=subidy_config['api_version'],
+        response_cache=cache.ResponseCache(
+            max_size=subidy_config['cache_size'],
+            default_ttl=subidy_config['cache_ttl'],
+            ttls=cache.parse_ttls(subidy_config['cache_ttls'])),
+        max_requests=subidy_config['max_requests'],
+        lookup_timeout=subidy_config['lookup_timeout'],
+        http_transport=transport.get_transport_with_config(config),
+        search_timeout=subidy_config['search_timeout'],
+        search_max_results=subidy_config['search_max_results'],
+        search_pages=subidy_config['search_pages'],
+        browse_timeout=subidy_config['browse_timeout'])
     sapi.mopidy_base_uri = subidy_config['uri_prefix']
+    sapi.coverart_sizes = sorted(int(size) for size in subidy_config['coverart_sizes'] or ())
+    if subidy_config['snapshot']:
+        data_dir = mopidy_subidy.SubidyExtension.get_data_dir(config)
+        sapi.snapshot = snapshot.LibrarySnapshot(snapshot.get_snapshot_path(data_dir))
+        sapi.library_sync = sync.LibrarySync(sapi, sapi.snapshot, subidy_config['backfill_albums'])
+        sapi.facets = facets.LibraryFacets()
+        if subidy_config['local_search']:
+            sapi.search_index = search_index.SearchIndex()
+            sapi.search_index_max_age = 2 * subidy_config['snapshot_refresh_interval']
     return sapi
 
 class SubsonicApi():
-    def __init__(self, url, username, password, app_name, legacy_auth, api_version):
+    def __init__(self, url, username, password, app_name, legacy_auth, api_version, response_cache=None, max_requests=4, lookup_timeout=30, http_transport=None, search_timeout=5, search_max_results=1000, search_pages=1, browse_timeout=10):
         parsed = urlparse(url)
         self.port = parsed.port if parsed.port else \
             443 if parsed.scheme == 'https' else 80
@@ -66,9 +153,31 @@ class SubsonicApi():
             appName=app_name,
             legacyAuth=legacy_auth,
             apiVersion=api_version)
+        self.transport = http_transport if http_transport is not None else transport.PooledTransport()
+        self.connection._opener = self.transport
         self.url = url + '/rest'
         self.username = username
         self.password = password
+        self.cache = response_cache if response_cache is not None else cache.ResponseCache(max_size=0)
+        self.snapshot = None
+        self.library_sync = None
+        self.search_index = None
+        self.facets = None
+        self.name_index = search_index.NameIndex(string_nums_nocase_sort_key)
+        self.single_flight = singleflight.get_shared_single_flight()
+        self.search_index_max_age = 0
+        self.indexed_snapshot_version = None
+        self.coverart_sizes = []
+        self.coverart_ids = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_requests)
+        # Separate from executor, whose workers the provider calls wait on.
+        self.provider_executor = concurrent.futures.ThreadPoolExecutor(max_requests)
+        self.max_requests = max_requests
+        self.browse_timeout = browse_timeout
+        self.lookup_timeout = lookup_timeout
+        self.search_timeout = search_timeout
+        self.search_max_results = search_max_results
+        self.search_pages = search_pages
         logger.info('Connecting to subsonic server on url %s as user %s, API version %s' % (url, username, api_version))
         try:
             self.connection.ping()
@@ -76,6 +185,108 @@ class SubsonicApi():
             logger.error('Unable to reach subsonic server: %s' % e)
             exit()
 
+    def call(self, endpoint, *args, **kwargs):
+        key = cache.make_key(endpoint, args, kwargs)
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+        # Identical requests already on their way (from this or another
+        # SubsonicApi in the process) are waited for instead of repeated.
+        return self.single_flight.do(key, lambda: self.fetch(key, endpoint, args, kwargs))
+
+    def fetch(self, key, endpoint, args, kwargs):
+        response = getattr(self.connection, endpoint)(*args, **kwargs)
+        if response.get('status') == RESPONSE_OK:
+            response = records.compact(response)
+            self.cache.put(key, response)
+            self.index_response_coverart_ids(endpoint, response)
+            if self.snapshot is not None:
+                self.snapshot.observe(endpoint, response)
+            if self.facets is not None and self.facets.built and endpoint == 'getAlbum':
+                album = response.get('album') or {}
+                self.facets.update_album(album.get('id'), album.get('song') or [], album)
+        return response
+
+    def map_ordered(self, fn, items, deadline=None):
+        # Runs fn over items on the worker pool and returns the results in
+        # the order of items. Results still missing at the deadline are None.
+        futures = [self.executor.submit(fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                results.append(future.result(timeout=remaining))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                results.append(None)
+        return results
+
+    def call_with_deadline(self, fn, *args):
+        # Runs a provider call off the backend actor and stops waiting for
+        # it after browse_timeout, returning None. The call keeps going and
+        # its responses still land in the cache for the next try.
+        future = self.provider_executor.submit(fn, *args)
+        try:
+            return future.result(timeout=self.browse_timeout)
+        except concurrent.futures.TimeoutError:
+            logger.warning('Subsonic took longer than %ds to answer, returning nothing for now.' % self.browse_timeout)
+            return None
+
+    def get_lookup_deadline(self):
+        return time.time() + self.lookup_timeout
+
+    def refresh_snapshot(self):
+        # Returns whether the songs of every album are in the snapshot.
+        if self.library_sync is not None:
+            self.library_sync.sync()
+        if self.snapshot is None:
+            return True
+        # Read first, so writes during the rebuild trigger another one.
+        version = self.snapshot.version
+        albums = self.snapshot.get('albums')
+        synced_album_ids = self.snapshot.get_synced_album_ids()
+        complete = all(album.get('id') in synced_album_ids for album in albums)
+        self.name_index.build(self.snapshot.get('artists'), albums)
+        build_search_index = self.search_index is not None
+        build_facets = self.facets is not None and complete and not self.facets.built
+        if build_search_index or build_facets:
+            if version != self.indexed_snapshot_version:
+                # Songs are loaded once and only when the snapshot changed.
+                songs = self.snapshot.get_all_songs()
+                if build_search_index:
+                    self.search_index.build(songs, albums, complete)
+                if build_facets:
+                    self.facets.build(songs, albums)
+                self.indexed_snapshot_version = version
+            elif build_search_index:
+                self.search_index.touch()
+        if self.facets is not None:
+            genres = self.get_raw_genres()
+            if genres:
+                self.facets.set_genres([genre.get('value') for genre in genres if genre.get('value')])
+        return complete
+
+    def get_snapshot_index(self, index):
+        if self.snapshot is None:
+            return None
+        try:
+            return self.snapshot.get(index) or None
+        except Exception as e:
+            logger.warning('Reading library snapshot failed: %s' % e)
+            return None
+
+    def invalidate_cache(self, a_uri=None):
+        item_id = uri.get_id(a_uri) if a_uri is not None else None
+        if item_id is None or uri.get_type(a_uri) == uri.VDIR:
+            self.cache.invalidate()
+            self.coverart_ids.clear()
+            if self.snapshot is None:
+                self.name_index.built = False
+        else:
+            self.cache.invalidate(lambda key: cache.key_mentions(key, item_id))
+            for key in [key for key in list(self.coverart_ids) if key[1] == item_id]:
+                self.coverart_ids.pop(key, None)
+
     def get_subsonic_uri(self, view_name, params, censor=False):
         di_params = {}
         di_params.update(params)
@@ -93,27 +304,29 @@ class SubsonicApi():
     def get_censored_song_stream_uri(self, song_id):
         return self.get_subsonic_uri('stream', dict(id=song_id), True)
 
-    def get_coverart_image_uri(self, aid):
-        return self.get_subsonic_uri('getCoverArt', dict(id=aid))
+    def get_coverart_image_uri(self, aid, size=None):
+        params = dict(id=aid) if size is None else dict(id=aid, size=size)
+        return self.get_subsonic_uri('getCoverArt', params)
 
-    def get_censored_coverart_image_uri(self, aid):
-        return self.get_subsonic_uri('getCoverArt', dict(id=aid), True)
+    def get_censored_coverart_image_uri(self, aid, size=None):
+        params = dict(id=aid) if size is None else dict(id=aid, size=size)
+        return self.get_subsonic_uri('getCoverArt', params, True)
 
-    def find_raw(self, query, exclude_artists=False, exclude_albums=False, exclude_songs=False, id3=False):
+    def find_raw(self, query, exclude_artists=False, exclude_albums=False, exclude_songs=False, id3=False, offset=0):
         try:
             search_methods = dict(
-                folders = dict(fn=self.connection.search2, tag="searchResult2"),
-                id3 = dict(fn=self.connection.search3, tag="searchResult3"),
+                folders = dict(endpoint="search2", tag="searchResult2"),
+                id3 = dict(endpoint="search3", tag="searchResult3"),
             )
             if id3:
                 search_method = search_methods["id3"]
             else:
                 search_method = search_methods["folders"]
-            response = search_method["fn"](
+            response = self.call(search_method["endpoint"],
                 query.encode('utf-8'),
-                MAX_SEARCH_RESULTS if not exclude_artists else 0, 0,
-                MAX_SEARCH_RESULTS if not exclude_albums else 0, 0,
-                MAX_SEARCH_RESULTS if not exclude_songs else 0, 0)
+                MAX_SEARCH_RESULTS if not exclude_artists else 0, offset,
+                MAX_SEARCH_RESULTS if not exclude_albums else 0, offset,
+                MAX_SEARCH_RESULTS if not exclude_songs else 0, offset)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when searching.')
             return None
@@ -122,13 +335,71 @@ class SubsonicApi():
             return None
         return response.get(search_method["tag"])
 
+    def find_raw_page(self, query, kind, offset, id3=False):
+        # One page of `kind` ('artist', 'album' or 'song') results.
+        result = self.find_raw(query, exclude_artists=kind != 'artist', exclude_albums=kind != 'album', exclude_songs=kind != 'song', id3=id3, offset=offset)
+        return (result or {}).get(kind) or []
+
+    def find_raw_iter(self, query, kind, id3=False, first_page=None):
+        # Yields every `kind` result of the search. Pages are requested with
+        # the *Offset parameters, the next one is prefetched on the worker
+        # pool while the current one is being consumed, so results are never
+        # all fetched up front.
+        page = first_page if first_page is not None else self.find_raw_page(query, kind, 0, id3)
+        offset = 0
+        while page:
+            offset += len(page)
+            next_page = self.executor.submit(self.find_raw_page, query, kind, offset, id3) if len(page) >= MAX_SEARCH_RESULTS else None
+            for item in page:
+                yield item
+            page = next_page.result() if next_page is not None else None
+
+    def find_distinct_names_iter(self, query, kind):
+        seen = set()
+        for item in self.find_raw_iter(query, kind, id3=True):
+            name = item.get('title') if kind == 'song' else item.get('name')
+            if name and name not in seen:
+                seen.add(name)
+                yield name
+
     def find_as_search_result(self, query, exclude_artists=False, exclude_albums=False, exclude_songs=False):
-        result_folders = self.find_raw(query, exclude_artists=exclude_artists, exclude_albums=exclude_albums, exclude_songs=True)
+        search_result = None
+        for search_result in self.find_as_search_result_iter(query, exclude_artists, exclude_albums, exclude_songs):
+            pass
+        return search_result
+
+    def find_as_search_result_iter(self, query, exclude_artists=False, exclude_albums=False, exclude_songs=False):
+        # search2 and search3 run concurrently. The first page of id3
+        # results is yielded as soon as it arrives, then the complete id3
+        # results, merged with the folder results if search2 answered within
+        # search_timeout.
+        deadline = time.time() + self.search_timeout
+        folders_future = self.executor.submit(self.find_raw, query, exclude_artists=exclude_artists, exclude_albums=exclude_albums, exclude_songs=True)
         result_id3 = self.find_raw(query, exclude_artists=exclude_artists, exclude_albums=exclude_albums, exclude_songs=exclude_songs, id3=True)
-        if result_folders is None:
-            result_folders = dict()
         if result_id3 is None:
-            return None
+            folders_future.cancel()
+            return
+        yield self.raw_search_results_to_search_result(query, result_id3, dict())
+        # Kinds the first page cut off get up to search_pages pages in all,
+        # the extra pages of every kind are requested at once.
+        result_id3 = dict(result_id3)
+        pages_wanted = [(kind, page * MAX_SEARCH_RESULTS) for kind in ('artist', 'album', 'song')
+            if len(result_id3.get(kind) or []) >= MAX_SEARCH_RESULTS for page in range(1, self.search_pages)]
+        pages = self.map_ordered(lambda page: self.find_raw_page(query, page[0], page[1], id3=True), pages_wanted, deadline)
+        complete_kinds = set()
+        for (kind, offset), page in zip(pages_wanted, pages):
+            if kind not in complete_kinds:
+                result_id3[kind] = list(result_id3.get(kind) or []) + (page or [])
+                if page is None or len(page) < MAX_SEARCH_RESULTS:
+                    complete_kinds.add(kind)
+        try:
+            result_folders = folders_future.result(timeout=max(0, deadline - time.time()))
+        except concurrent.futures.TimeoutError:
+            logger.warning('Searching subsonic folders took too long, returning id3 results only.')
+            result_folders = None
+        yield self.raw_search_results_to_search_result(query, result_id3, result_folders or dict())
+
+    def raw_search_results_to_search_result(self, query, result_id3, result_folders):
         artists_map = {}
         albums_map = {}
         for artist in result_folders.get('artist') or []:
@@ -151,6 +422,45 @@ class SubsonicApi():
             albums=out_albums,
             tracks=[self.raw_song_to_track(song) for song in (result_id3.get('song') or [])])
 
+    def find_local_as_search_result(self, query, exact=False):
+        # Returns None when the local index can't answer the query, so the
+        # caller falls back to searching on the server.
+        if self.search_index is None or not self.search_index.supports(query):
+            return None
+        if not self.search_index.is_fresh(self.search_index_max_age):
+            logger.debug('Local search index is incomplete or stale, searching on the server.')
+            return None
+        songs = self.search_index.search(query, exact, self.search_max_results)
+        albums = collections.OrderedDict()
+        artists = collections.OrderedDict()
+        for song in songs:
+            albums.setdefault(song.get('albumId'), song)
+            artists.setdefault(song.get('artistId'), song)
+        return SearchResult(
+            uri=uri.get_search_uri(' '.join(value for values in query.values() for value in values)),
+            artists=[shared_model(Artist, name=song.get('artist'), uri=uri.get_artist_uri(artist_id)) for artist_id, song in artists.items() if artist_id is not None],
+            albums=[shared_model(Album, name=song.get('album'), uri=uri.get_album_uri(album_id)) for album_id, song in albums.items() if album_id is not None],
+            tracks=[self.raw_song_to_track(song) for song in songs])
+
+    def get_name_index(self):
+        # Normally kept warm by the snapshot refresher, built on first use
+        # otherwise.
+        if not self.name_index.built:
+            self.name_index.build(self.get_raw_artists(), self.get_snapshot_index('albums') or [])
+        return self.name_index
+
+    def find_raw_artists_and_albums_by_name(self, artist_name, album_name):
+        name_index = self.get_name_index()
+        artists = name_index.find_artists(artist_name)
+        artist_ids = set(artist.get('id') for artist in artists)
+        albums = name_index.find_albums(album_name, artist_ids)
+        if not albums and self.get_snapshot_index('albums') is None:
+            # Without an album index, list the albums of the matching artists.
+            album_key = search_index.normalize(album_name)
+            albums = [album for artist in artists for album in self.get_raw_albums(artist.get('id'))
+                if album_key in search_index.normalize(album.get('name') or '')]
+        return artists, albums
+
     def find_iter(self, query, exclude_artists=False, exclude_albums=False, exclude_songs=False):
         result = self.find_raw(query)
         if result is None:
@@ -171,6 +481,7 @@ class SubsonicApi():
         if response.get('status') != RESPONSE_OK:
             logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
             return None
+        self.cache.invalidate_endpoints('getPlaylists', 'getPlaylist')
         return response
 
     def delete_playlist_raw(self, playlist_id):
@@ -182,6 +493,7 @@ class SubsonicApi():
         if response.get('status') != RESPONSE_OK:
             logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
             return None
+        self.cache.invalidate_endpoints('getPlaylists', 'getPlaylist')
         return response
 
     def save_playlist_raw(self, playlist_id, song_ids):
@@ -193,11 +505,18 @@ class SubsonicApi():
         if response.get('status') != RESPONSE_OK:
             logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
             return None
+        self.cache.invalidate_endpoints('getPlaylists', 'getPlaylist')
         return response
 
     def get_raw_artists(self):
+        artists = self.get_snapshot_index('artists')
+        if artists is not None:
+            return artists
+        return self.fetch_raw_artists()
+
+    def fetch_raw_artists(self):
         try:
-            response = self.connection.getArtists()
+            response = self.call('getArtists')
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading list of artists.')
             return []
@@ -211,9 +530,27 @@ class SubsonicApi():
         logger.warning('Subsonic does not seem to have any artists in it\'s library.')
         return []
 
+    def get_raw_indexes(self, if_modified_since=0):
+        try:
+            response = self.call('getIndexes', ifModifiedSince=if_modified_since)
+        except Exception as e:
+            logger.warning('Connecting to subsonic failed when loading indexes.')
+            return None
+        if response.get('status') != RESPONSE_OK:
+            logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
+            return None
+        return response.get('indexes')
+
     def get_raw_rootdirs(self):
+        rootdirs = self.get_snapshot_index('rootdirs')
+        if rootdirs is None:
+            rootdirs = self.fetch_raw_rootdirs()
+        self.index_coverart_ids(uri.DIRECTORY, rootdirs)
+        return rootdirs
+
+    def fetch_raw_rootdirs(self):
         try:
-            response = self.connection.getIndexes()
+            response = self.call('getIndexes')
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading list of rootdirs.')
             return []
@@ -239,12 +576,21 @@ class SubsonicApi():
         artist = self.get_raw_artist(artist_id)
         return self.raw_artist_to_artist(artist) if artist is not None else None
 
-    def get_coverart_image_by_id(self, a_id):
-        return self.raw_imageuri_to_image(''.join((self.mopidy_base_uri, ('' if self.mopidy_base_uri.endswith("/") else '/'), mopidy_subidy.SubidyExtension.ext_name, '/cover_art?id=', urllib.quote_plus(a_id))))
+    def get_coverart_image_by_id(self, a_id, size=None):
+        image_uri = ''.join((self.mopidy_base_uri, ('' if self.mopidy_base_uri.endswith("/") else '/'), mopidy_subidy.SubidyExtension.ext_name, '/cover_art?id=', urllib.quote_plus(a_id)))
+        if size is None:
+            return self.raw_imageuri_to_image(image_uri)
+        return self.raw_imageuri_to_image('%s&size=%d' % (image_uri, size), size)
+
+    def get_coverart_image_uris(self, a_id):
+        return (self.get_coverart_image_by_id(a_id).uri,) if a_id is not None else ()
+
+    def get_coverart_images_by_id(self, a_id):
+        return [self.get_coverart_image_by_id(a_id, size) for size in self.coverart_sizes] + [self.get_coverart_image_by_id(a_id)]
 
     def get_raw_playlists(self):
         try:
-            response = self.connection.getPlaylists()
+            response = self.call('getPlaylists')
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading list of playlists.')
             return []
@@ -259,7 +605,7 @@ class SubsonicApi():
 
     def get_raw_playlist(self, playlist_id):
         try:
-            response = self.connection.getPlaylist(playlist_id)
+            response = self.call('getPlaylist', playlist_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading playlist.')
             return None
@@ -270,7 +616,7 @@ class SubsonicApi():
 
     def get_raw_dir(self, parent_id):
         try:
-            response = self.connection.getMusicDirectory(parent_id)
+            response = self.call('getMusicDirectory', parent_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when listing content of music directory.')
             return None
@@ -279,13 +625,46 @@ class SubsonicApi():
             return None
         directory = response.get('directory')
         if directory is not None:
-            diritems = directory.get('child')
+            diritems = directory.get('child') or []
+            self.index_coverart_ids(uri.DIRECTORY, (item for item in diritems if item.get('isDir')))
             return sorted(diritems, key=diritem_sort_key)
         return None
 
+    def index_coverart_ids(self, item_type, items):
+        # Remembers the coverArt of every item seen in a listing (None
+        # included), so cover art lookups don't need another request.
+        entries = [((item_type, item.get('id')), item.get('coverArt')) for item in items]
+        if len(self.coverart_ids) + len(entries) > COVERART_ID_CACHE_SIZE:
+            self.coverart_ids.clear()
+        self.coverart_ids.update(entries)
+
+    def index_response_coverart_ids(self, endpoint, response):
+        if endpoint == 'getSong':
+            self.index_coverart_ids(uri.SONG, [response.get('song') or {}])
+        elif endpoint == 'getAlbum':
+            album = response.get('album') or {}
+            self.index_coverart_ids(uri.ALBUM, [album])
+            self.index_coverart_ids(uri.SONG, album.get('song') or [])
+        elif endpoint == 'getArtist':
+            artist = response.get('artist') or {}
+            self.index_coverart_ids(uri.ARTIST, [artist])
+            self.index_coverart_ids(uri.ALBUM, artist.get('album') or [])
+        elif endpoint == 'getAlbumList2':
+            self.index_coverart_ids(uri.ALBUM, (response.get('albumList2') or {}).get('album') or [])
+        elif endpoint == 'getMusicDirectory':
+            children = (response.get('directory') or {}).get('child') or []
+            self.index_coverart_ids(uri.SONG, (child for child in children if not child.get('isDir')))
+        elif endpoint == 'getPlaylist':
+            self.index_coverart_ids(uri.SONG, (response.get('playlist') or {}).get('entry') or [])
+        elif endpoint == 'search3':
+            result = response.get('searchResult3') or {}
+            self.index_coverart_ids(uri.ARTIST, result.get('artist') or [])
+            self.index_coverart_ids(uri.ALBUM, result.get('album') or [])
+            self.index_coverart_ids(uri.SONG, result.get('song') or [])
+
     def get_raw_dirinfo(self, parent_id):
         try:
-            response = self.connection.getMusicDirectory(parent_id)
+            response = self.call('getMusicDirectory', parent_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading music directory.')
             return None
@@ -296,7 +675,7 @@ class SubsonicApi():
 
     def get_raw_artist(self, artist_id):
         try:
-            response = self.connection.getArtist(artist_id)
+            response = self.call('getArtist', artist_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading artist.')
             return None
@@ -307,7 +686,7 @@ class SubsonicApi():
 
     def get_raw_albums(self, artist_id):
         try:
-            response = self.connection.getArtist(artist_id)
+            response = self.call('getArtist', artist_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading list of albums.')
             return []
@@ -316,12 +695,12 @@ class SubsonicApi():
             return []
         albums = response.get('artist').get('album')
         if albums is not None:
-            return sorted(albums, key=lambda album: string_nums_nocase_sort_key(album['name']))
+            return sorted(albums, key=name_sort_key)
         return []
 
     def get_raw_album(self, album_id):
         try:
-            response = self.connection.getAlbum(album_id)
+            response = self.call('getAlbum', album_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading album.')
             return None
@@ -332,7 +711,7 @@ class SubsonicApi():
 
     def get_raw_songs(self, album_id):
         try:
-            response = self.connection.getAlbum(album_id)
+            response = self.call('getAlbum', album_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading list of songs in album.')
             return []
@@ -344,9 +723,34 @@ class SubsonicApi():
             return songs
         return []
 
+    def get_raw_starred(self):
+        try:
+            response = self.call('getStarred2')
+        except Exception as e:
+            logger.warning('Connecting to subsonic failed when loading starred items.')
+            return None
+        if response.get('status') != RESPONSE_OK:
+            logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
+            return None
+        return response.get('starred2') or {}
+
+    def get_raw_random_songs(self, size):
+        try:
+            response = self.call('getRandomSongs', size=size)
+        except Exception as e:
+            logger.warning('Connecting to subsonic failed when loading random songs.')
+            return None
+        if response.get('status') != RESPONSE_OK:
+            logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
+            return None
+        songs = (response.get('randomSongs') or {}).get('song')
+        if songs is not None:
+            return songs
+        return []
+
     def get_raw_song(self, song_id):
         try:
-            response = self.connection.getSong(song_id)
+            response = self.call('getSong', song_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading song.')
             return None
@@ -355,23 +759,68 @@ class SubsonicApi():
             return None
         return response.get('song')
 
-    def get_raw_album_list(self, ltype, size=MAX_LIST_RESULTS):
+    def get_raw_genres(self):
         try:
-            response = self.connection.getAlbumList2(ltype=ltype, size=size)
+            response = self.call('getGenres')
+        except Exception as e:
+            logger.warning('Connecting to subsonic failed when loading list of genres.')
+            return None
+        if response.get('status') != RESPONSE_OK:
+            logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
+            return None
+        genres = (response.get('genres') or {}).get('genre')
+        if genres is not None:
+            return genres
+        return []
+
+    def get_raw_album_list(self, ltype, size=MAX_LIST_RESULTS, offset=0, genre=None, fresh=False):
+        kwargs = dict(ltype=ltype, size=size, offset=offset)
+        if genre is not None:
+            kwargs.update(genre=genre)
+        if fresh:
+            self.cache.discard('getAlbumList2', **kwargs)
+        try:
+            response = self.call('getAlbumList2', **kwargs)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading album list.')
-            return []
+            return None
         if response.get('status') != RESPONSE_OK:
             logger.warning('Got non-okay status code from subsonic: %s' % response.get('status'))
-            return []
+            return None
         albums = response.get('albumList2').get('album')
         if albums is not None:
             return albums
         return []
 
+    def get_raw_album_list_all(self, ltype, genre=None):
+        # The first page is requested alone, most genres and small libraries
+        # fit in it. After a full first page the rest is requested
+        # max_requests pages at a time, the first short page ends the list.
+        # Each page is cached on its own by call(). Returns None when a page
+        # fails, a partial list would look like the end.
+        albums = self.get_raw_album_list(ltype, genre=genre)
+        if albums is None or len(albums) < MAX_LIST_RESULTS:
+            return albums
+        albums = list(albums)
+        while True:
+            offsets = [len(albums) + i * MAX_LIST_RESULTS for i in range(self.max_requests)]
+            pages = self.map_ordered(lambda offset: self.get_raw_album_list(ltype, offset=offset, genre=genre), offsets)
+            for page in pages:
+                if page is None:
+                    return None
+                albums.extend(page)
+                if len(page) < MAX_LIST_RESULTS:
+                    return albums
+
+    def get_raw_all_albums(self):
+        albums = self.get_snapshot_index('albums')
+        if albums is not None:
+            return albums
+        return self.get_raw_album_list_all('alphabeticalByName') or []
+
     def get_raw_song(self, song_id):
         try:
-            response = self.connection.getSong(song_id)
+            response = self.call('getSong', song_id)
         except Exception as e:
             logger.warning('Connecting to subsonic failed when loading song.')
             return None
@@ -381,9 +830,54 @@ class SubsonicApi():
         return response.get('song')
 
     def get_albums_as_refs(self, artist_id=None):
-        albums = (self.get_raw_album_list('alphabeticalByName') if artist_id is None else self.get_raw_albums(artist_id))
+        albums = (self.get_raw_all_albums() if artist_id is None else self.get_raw_albums(artist_id))
+        return [self.raw_album_to_ref(album) for album in albums]
+
+    def get_album_buckets(self):
+        buckets = {}
+        for album in sorted(self.get_raw_all_albums(), key=name_sort_key):
+            buckets.setdefault(get_album_bucket(album), []).append(album)
+        return collections.OrderedDict(sorted(buckets.items()))
+
+    def get_album_buckets_as_refs(self):
+        return [Ref.directory(name=bucket, uri=uri.get_vdir_uri('albums:%s' % bucket)) for bucket in self.get_album_buckets()]
+
+    def get_album_bucket_as_refs(self, bucket):
+        return [self.raw_album_to_ref(album) for album in self.get_album_buckets().get(bucket, [])]
+
+    # The list refs below are None when the request failed, so the browse
+    # lists can keep what they had.
+    def get_album_list_as_refs(self, ltype, size=MAX_LIST_RESULTS, fresh=False):
+        albums = self.get_raw_album_list(ltype, size, fresh=fresh)
+        if albums is None:
+            return None
         return [self.raw_album_to_ref(album) for album in albums]
 
+    def get_genre_albums_as_refs(self, genre):
+        albums = self.get_raw_album_list_all('byGenre', genre=genre) or []
+        return [self.raw_album_to_ref(album) for album in sorted(albums, key=name_sort_key)]
+
+    def get_genres_as_refs(self):
+        raw_genres = self.get_raw_genres()
+        if raw_genres is None:
+            return None
+        genres = sorted((genre.get('value') for genre in raw_genres if genre.get('value')), key=string_nums_nocase_sort_key)
+        return [Ref.directory(name=genre, uri=uri.get_vdir_uri('genres:%s' % genre)) for genre in genres]
+
+    def get_starred_as_refs(self):
+        starred = self.get_raw_starred()
+        if starred is None:
+            return None
+        return ([self.raw_artist_to_ref(artist) for artist in starred.get('artist') or []] +
+            [self.raw_album_to_ref(album) for album in starred.get('album') or []] +
+            [self.raw_song_to_ref(song) for song in starred.get('song') or []])
+
+    def get_random_songs_as_refs(self, size):
+        songs = self.get_raw_random_songs(size)
+        if songs is None:
+            return None
+        return [self.raw_song_to_ref(song) for song in songs]
+
     def get_albums_as_albums(self, artist_id):
         return [self.raw_album_to_album(album) for album in self.get_raw_albums(artist_id)]
 
@@ -391,7 +885,7 @@ class SubsonicApi():
         return [self.raw_song_to_ref(song) for song in self.get_raw_songs(album_id)]
 
     def get_songs_as_tracks(self, album_id):
-        return [self.raw_song_to_track(song) for song in self.get_raw_songs(album_id)]
+        return self.raw_album_songs_to_tracks(self.get_raw_album(album_id))
 
     def get_artists_as_refs(self):
         return [self.raw_artist_to_ref(artist) for artist in self.get_raw_artists()]
@@ -424,21 +918,75 @@ class SubsonicApi():
         albums = self.get_raw_albums(artist_id)
         if albums is None:
             return
-        for album in albums:
-            for song in self.get_raw_songs(album.get('id')):
-                yield self.raw_song_to_track(song)
+        album_ids = [album.get('id') for album in albums]
+        raw_albums = self.map_ordered(self.get_raw_album, album_ids, self.get_lookup_deadline())
+        for album_id, album in zip(album_ids, raw_albums):
+            if album is None:
+                logger.warning('Loading songs of album %s failed or took too long, skipping it.' % album_id)
+                continue
+            for track in self.raw_album_songs_to_tracks(album):
+                yield track
 
     def get_recursive_dir_as_songs_as_tracks_iter(self, directory_id):
-        diritems = self.get_raw_dir(directory_id)
-        if diritems is None:
-            return
-        for item in diritems:
+        # Fetch the tree one level at a time with all directories of a level
+        # in parallel, then walk it depth-first to keep the track order.
+        deadline = self.get_lookup_deadline()
+        tree = {}
+        pending = [directory_id]
+        while pending:
+            if time.time() > deadline:
+                logger.warning('Loading directory %s took too long, skipping %d subdirectories.' % (directory_id, len(pending)))
+                break
+            for dir_id, diritems in zip(pending, self.map_ordered(self.get_raw_dir, pending, deadline)):
+                tree[dir_id] = diritems
+            pending = [item.get('id') for dir_id in pending for item in (tree[dir_id] or [])
+                if item.get('isDir') and item.get('id') not in tree]
+        for track in self.walk_dir_tree_as_tracks_iter(tree, directory_id):
+            yield track
+
+    def walk_dir_tree_as_tracks_iter(self, tree, directory_id, seen=None):
+        seen = set() if seen is None else seen
+        seen.add(directory_id)
+        for item in tree.get(directory_id) or []:
             if item.get('isDir'):
-                for song in self.get_recursive_dir_as_songs_as_tracks_iter(item.get('id')):
-                    yield song
+                if item.get('id') not in seen:
+                    for track in self.walk_dir_tree_as_tracks_iter(tree, item.get('id'), seen):
+                        yield track
             else:
                 yield self.raw_song_to_track(item)
 
+    def get_tracks_by_ids(self, song_ids=(), album_ids=()):
+        # Songs already known from the snapshot are grouped by album, so
+        # each album costs one getAlbum call instead of one getSong per
+        # song; all albums and the remaining songs are fetched in parallel.
+        deadline = self.get_lookup_deadline()
+        song_album_ids = {}
+        if self.snapshot is not None:
+            for song_id in song_ids:
+                known_song = self.snapshot.get_song(song_id)
+                if known_song is not None and known_song.get('albumId') is not None:
+                    song_album_ids[song_id] = known_song.get('albumId')
+        fetch_album_ids = list(collections.OrderedDict.fromkeys(
+            list(album_ids) + list(song_album_ids.values())))
+        albums = dict(zip(fetch_album_ids, self.map_ordered(self.get_raw_album, fetch_album_ids, deadline)))
+        album_models = dict((album_id, self.raw_album_to_album(album)) for album_id, album in albums.items() if album is not None)
+        songs = dict((song.get('id'), song) for album in albums.values() if album is not None for song in album.get('song') or [])
+        missing_song_ids = [song_id for song_id in song_ids if song_id not in songs]
+        for song_id, song in zip(missing_song_ids, self.map_ordered(self.get_raw_song, missing_song_ids, deadline)):
+            if song is not None:
+                songs[song_id] = song
+        tracks_by_song_id = dict(
+            (song_id, self.raw_song_to_track(song, album_models.get(song.get('albumId')) if song is not None else None))
+            for song_id, song in ((song_id, songs.get(song_id)) for song_id in song_ids))
+        tracks_by_album_id = dict((album_id, self.raw_album_songs_to_tracks(albums.get(album_id))) for album_id in album_ids)
+        return tracks_by_song_id, tracks_by_album_id
+
+    def raw_album_songs_to_tracks(self, album):
+        if album is None:
+            return []
+        album_model = self.raw_album_to_album(album)
+        return [self.raw_song_to_track(song, album_model) for song in album.get('song') or []]
+
     def raw_song_to_ref(self, song):
         if song is None:
             return None
@@ -446,24 +994,37 @@ class SubsonicApi():
             name=song.get('title') or UNKNOWN_SONG,
             uri=uri.get_song_uri(song.get('id')))
 
-    def raw_song_to_track(self, song):
+    def raw_song_to_track(self, song, album=None):
+        # album is the Album model of the getAlbum response the song came
+        # from, when there is one; otherwise it is made from the song.
         if song is None:
             return None
         return Track(
             name=song.get('title') or UNKNOWN_SONG,
             uri=uri.get_song_uri(song.get('id')),
             bitrate=song.get('bitRate'),
-            track_no=int(song.get('track')) if song.get('track') else None,
-            date=str(song.get('year')) or 'none',
+            track_no=parse_number(song.get('track')),
+            date=format_year(song.get('year')),
             genre=song.get('genre'),
             length=int(song.get('duration')) * 1000 if song.get('duration') else None,
-            disc_no=int(song.get('discNumber')) if song.get('discNumber') else None,
-            artists=[Artist(
+            disc_no=parse_number(song.get('discNumber')),
+            comment=song.get('comment'),
+            musicbrainz_id=song.get('musicBrainzId'),
+            last_modified=parse_timestamp(song.get('created')),
+            artists=[shared_model(Artist,
                 name=song.get('artist'),
                 uri=uri.get_artist_uri(song.get('artistId')))],
-            album=Album(
-                name=song.get('album'),
-                uri=uri.get_album_uri(song.get('albumId'))))
+            album=album if album is not None else self.raw_song_to_album(song))
+
+    def raw_song_to_album(self, song):
+        return shared_model(Album,
+            name=song.get('album'),
+            uri=uri.get_album_uri(song.get('albumId')),
+            artists=tuple(shared_model(Artist,
+                name=artist.get('name'),
+                uri=uri.get_artist_uri(artist.get('id'))) for artist in song.get('albumArtists') or ()),
+            date=format_year(song.get('year')),
+            images=self.get_coverart_image_uris(song.get('coverArt')))
 
     def raw_album_to_ref(self, album):
         if album is None:
@@ -475,13 +1036,19 @@ class SubsonicApi():
     def raw_album_to_album(self, album):
         if album is None:
             return None
-        return Album(
+        # Only getAlbum responses come with their songs to count discs in.
+        songs = album.get('song') or ()
+        return shared_model(Album,
             name=album.get('title') or album.get('name') or UNKNOWN_ALBUM,
             num_tracks=album.get('songCount'),
+            num_discs=max(parse_number(song.get('discNumber'), 1) for song in songs) if songs else None,
+            date=format_year(album.get('year')),
+            musicbrainz_id=album.get('musicBrainzId'),
+            images=self.get_coverart_image_uris(album.get('coverArt')),
             uri=uri.get_album_uri(album.get('id')),
-            artists=[Artist(
+            artists=(shared_model(Artist,
                 name=album.get('artist'),
-                uri=uri.get_artist_uri(album.get('artistId')))])
+                uri=uri.get_artist_uri(album.get('artistId'))),))
 
     def raw_directory_to_ref(self, directory):
         if directory is None:
@@ -493,19 +1060,19 @@ class SubsonicApi():
     def raw_directory_to_artist(self, directory):
         if directory is None:
             return None
-        return Artist(
+        return shared_model(Artist,
             name=directory.get('name'),
             uri=uri.get_directory_uri(directory.get("id")))
 
     def raw_directory_to_album(self, directory):
         if directory is None:
             return None
-        return Album(
+        return shared_model(Album,
             name=directory.get('title'),
             uri=uri.get_directory_uri(directory.get("id")),
-            artists=[Artist(
+            artists=(shared_model(Artist,
                 name=directory.get('artist'),
-                uri=uri.get_directory_uri(directory.get('parent')))])
+                uri=uri.get_directory_uri(directory.get('parent'))),))
 
     def raw_artist_to_ref(self, artist):
         if artist is None:
@@ -517,8 +1084,10 @@ class SubsonicApi():
     def raw_artist_to_artist(self, artist):
         if artist is None:
             return None
-        return Artist(
+        return shared_model(Artist,
             name=artist.get('name') or UNKNOWN_ARTIST,
+            sortname=artist.get('sortName'),
+            musicbrainz_id=artist.get('musicBrainzId'),
             uri=uri.get_artist_uri(artist.get('id')))
 
     def raw_playlist_to_playlist(self, playlist):
@@ -538,9 +1107,11 @@ class SubsonicApi():
             uri=uri.get_playlist_uri(playlist.get('id')),
             name=playlist.get('name'))
 
-    def raw_imageuri_to_image(self, imageuri):
+    def raw_imageuri_to_image(self, imageuri, size=None):
         return Image(
-            uri=imageuri)
+            uri=imageuri,
+            width=size,
+            height=size)
 
     def coverart_item_id_by_song_id(self, song_id):
         coverart_item_id = self.get_raw_song(song_id)
@@ -564,15 +1135,45 @@ class SubsonicApi():
             return None
 
     def coverart_item_id_by_directory_id(self, directory_id):
-        # FIXME: may take long when directory_id's parent dir has many subdirs
+        if (uri.DIRECTORY, directory_id) in self.coverart_ids:
+            return self.coverart_ids[(uri.DIRECTORY, directory_id)]
+        # Not browsed yet: listing the parent fills the index for all siblings.
         dirinfo = self.get_raw_dirinfo(directory_id)
         if dirinfo is None:
             return None
         parentdir_id = dirinfo.get('parent')
         if parentdir_id is None:
             return None
-        parentdiritems = self.get_raw_dir(parentdir_id)
-        if parentdiritems is None:
-            return None
-        diritem = dict((d['id'], d) for d in parentdiritems).get(directory_id)
-        return diritem.get('coverArt')
+        self.get_raw_dir(parentdir_id)
+        return self.coverart_ids.get((uri.DIRECTORY, directory_id))
+
+    def get_coverart_item_ids(self, items):
+        # Resolves (uri type, id) pairs to coverArt ids. Ids seen in earlier
+        # responses or in the snapshot are used as they are; songs of albums
+        # known from the snapshot are resolved with one getAlbum per album,
+        # and whatever is left is looked up in parallel.
+        deadline = self.get_lookup_deadline()
+        items = list(collections.OrderedDict.fromkeys(items))
+        if self.snapshot is not None:
+            album_ids = []
+            for item_type, item_id in items:
+                if item_type == uri.SONG and (item_type, item_id) not in self.coverart_ids:
+                    known_song = self.snapshot.get_song(item_id)
+                    if known_song is not None:
+                        if 'coverArt' in known_song:
+                            self.index_coverart_ids(item_type, [known_song])
+                        elif known_song.get('albumId') is not None:
+                            album_ids.append(known_song.get('albumId'))
+            album_ids = list(collections.OrderedDict.fromkeys(album_ids))
+            self.map_ordered(self.get_raw_album, album_ids, deadline)
+        resolvers = {
+            uri.SONG: self.coverart_item_id_by_song_id,
+            uri.ALBUM: self.coverart_item_id_by_album_id,
+            uri.ARTIST: self.coverart_item_id_by_artist_id,
+            uri.DIRECTORY: self.coverart_item_id_by_directory_id,
+        }
+        missing = [item for item in items if item not in self.coverart_ids and item[0] in resolvers]
+        resolved = self.map_ordered(lambda item: resolvers[item[0]](item[1]), missing, deadline)
+        coverart_ids = dict(zip(missing, resolved))
+        coverart_ids.update((item, self.coverart_ids.get(item)) for item in items if item not in coverart_ids)
+        return coverart_ids
@@ -0,0 +1,136 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Albums whose songs are not in the snapshot yet are fetched a batch at a
+# time on every sync, so a large library fills up without a burst of
+# getAlbum requests on the first start.
+BACKFILL_ALBUMS_PER_SYNC = 1000
+
+def album_name_key(album):
+    return (album.get('name') or '').lower()
+
+def album_change_key(album):
+    # Retagging or adding/removing songs shows up in one of these.
+    return tuple(album.get(field) for field in ('songCount', 'duration', 'name', 'year', 'coverArt'))
+
+class LibrarySync(object):
+    def __init__(self, subsonic_api, snapshot, backfill_albums=BACKFILL_ALBUMS_PER_SYNC):
+        self.subsonic_api = subsonic_api
+        self.snapshot = snapshot
+        self.backfill_albums = backfill_albums
+
+    def sync(self):
+        indexes_changed = self.sync_indexes()
+        new_album_ids = self.sync_albums(full=indexes_changed)
+        if new_album_ids is None:
+            logger.warning('Loading the subsonic album list failed, keeping the previous library snapshot')
+            return
+        self.sync_songs(new_album_ids)
+
+    def sync_indexes(self):
+        last_modified = self.snapshot.get_meta('indexes_last_modified', 0)
+        if not self.snapshot.get('rootdirs'):
+            last_modified = 0
+        self.subsonic_api.cache.invalidate_endpoints('getIndexes')
+        indexes = self.subsonic_api.get_raw_indexes(if_modified_since=last_modified)
+        if indexes is None:
+            return False
+        letters = indexes.get('index')
+        # The server leaves out the index entries when nothing changed
+        # since ifModifiedSince.
+        if not letters:
+            logger.debug('Subsonic library unchanged since %s' % last_modified)
+            return False
+        logger.info('Subsonic library changed since %s, syncing indexes' % last_modified)
+        rootdirs = [artist for letter in letters for artist in letter.get('artist') or []]
+        self.snapshot.update('rootdirs', rootdirs)
+        self.subsonic_api.cache.invalidate_endpoints('getArtists', 'getAlbumList2', 'getMusicDirectory')
+        artists = self.subsonic_api.fetch_raw_artists()
+        if artists:
+            self.snapshot.update('artists', artists)
+        self.snapshot.set_meta('indexes_last_modified', indexes.get('lastModified', 0))
+        return True
+
+    def sync_albums(self, full=False):
+        watermark = self.snapshot.get_meta('albums_created_watermark')
+        albums = self.snapshot.get('albums')
+        if full or watermark is None or not albums:
+            albums = self.subsonic_api.get_raw_album_list_all('alphabeticalByName')
+            if albums is None:
+                return None
+            # On the first sync every album is unknown; leave those to the
+            # backfill instead of fetching the whole library at once.
+            known_albums = dict((album.get('id'), album) for album in self.snapshot.get('albums'))
+            new_albums = [album for album in albums if known_albums and (
+                album.get('id') not in known_albums or
+                album_change_key(album) != album_change_key(known_albums[album.get('id')]))]
+            self.snapshot.update('albums', albums)
+            self.prune_songs(albums)
+        else:
+            new_albums = self.get_raw_albums_created_after(watermark)
+            if new_albums is None:
+                return None
+            if new_albums:
+                known_ids = set(album.get('id') for album in albums)
+                merged = albums + [album for album in new_albums if album.get('id') not in known_ids]
+                self.snapshot.update('albums', sorted(merged, key=album_name_key))
+        created = [album.get('created') for album in albums + new_albums if album.get('created')]
+        if created:
+            self.snapshot.set_meta('albums_created_watermark', max(created))
+        logger.debug('Synced album index, %d new or changed albums' % len(new_albums))
+        return [album.get('id') for album in new_albums]
+
+    def prune_songs(self, albums):
+        removed_ids = self.snapshot.prune_songs(set(album.get('id') for album in albums))
+        facets = self.subsonic_api.facets
+        if facets is not None and facets.built:
+            for album_id in removed_ids:
+                facets.update_album(album_id, [], None)
+        if removed_ids:
+            logger.debug('Removed songs of %d deleted albums from the snapshot' % len(removed_ids))
+
+    def get_raw_albums_created_after(self, watermark):
+        # getAlbumList2 'newest' is ordered by creation date, so paging can
+        # stop at the first album that is not newer than the watermark.
+        self.subsonic_api.cache.invalidate_endpoints('getAlbumList2')
+        new_albums = []
+        offset = 0
+        while True:
+            page = self.subsonic_api.get_raw_album_list('newest', offset=offset)
+            if page is None:
+                return None
+            for album in page:
+                if (album.get('created') or '') <= watermark:
+                    return new_albums
+                new_albums.append(album)
+            if not page:
+                return new_albums
+            offset += len(page)
+
+    def sync_songs(self, changed_album_ids):
+        synced_ids = self.snapshot.get_synced_album_ids()
+        missing_ids = [album.get('id') for album in self.snapshot.get('albums') if album.get('id') not in synced_ids]
+        # Albums whose getAlbum failed before are retried after the ones
+        # never fetched.
+        backfill_ids = missing_ids + sorted(self.snapshot.get_failed_album_ids())
+        album_ids = list(changed_album_ids) + [
+            album_id for album_id in backfill_ids[:self.backfill_albums]
+            if album_id not in changed_album_ids]
+        for album_id in album_ids:
+            self.subsonic_api.cache.discard('getAlbum', album_id)
+        # get_raw_songs feeds the fresh responses into the snapshot. Batches
+        # of max_requests keep browsing lookups from queueing behind the
+        # whole backfill on the shared worker pool.
+        batch_size = self.subsonic_api.max_requests
+        for start in range(0, len(album_ids), batch_size):
+            self.subsonic_api.map_ordered(self.subsonic_api.get_raw_songs, album_ids[start:start + batch_size])
+        # Fetched albums went through observe(), empty ones included; the
+        # rest failed.
+        synced_ids = self.snapshot.get_synced_album_ids()
+        failed_ids = [album_id for album_id in album_ids if album_id not in synced_ids]
+        if failed_ids:
+            logger.warning('Loading the songs of %d albums failed, retrying them on the next sync' % len(failed_ids))
+            self.snapshot.mark_albums_failed(failed_ids)
+        if album_ids:
+            logger.debug('Synced songs of %d albums' % len(album_ids))
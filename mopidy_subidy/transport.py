@@ -0,0 +1,117 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urljoin
+from requests.structures import CaseInsensitiveDict
+from mopidy import httpclient
+import mopidy_subidy
+
+logger = logging.getLogger(__name__)
+
+# libsonic's PysHTTPRedirectHandler follows these with the POST body intact,
+# requests would turn them into body-less GETs.
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+class OpenerResponse(object):
+    # Just enough of the urllib2 response interface for libsonic.
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, *args):
+        return self.response.content
+
+    def info(self):
+        return self
+
+    def getheader(self, name, default=None):
+        return self.response.headers.get(name, default)
+
+    def get(self, name, default=None):
+        return self.response.headers.get(name, default)
+
+    def getcode(self):
+        return self.response.status_code
+
+    def close(self):
+        self.response.close()
+
+class PooledTransport(object):
+    def __init__(self, pool_size=10, timeout=30, proxy=None, user_agent=None):
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        if proxy:
+            self.session.proxies.update(http=proxy, https=proxy)
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def open(self, req, data=None, timeout=None):
+        # Drop-in replacement for the urllib2 opener of libsonic.Connection,
+        # so its requests reuse the pooled keep-alive connections.
+        if data is None:
+            data = req.get_data() if hasattr(req, 'get_data') else req.data
+        headers = CaseInsensitiveDict(req.header_items())
+        if data is not None:
+            # urllib2 only adds this inside its handler chain, libsonic sends
+            # the auth and query parameters as a form body.
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        url = req.get_full_url()
+        for _ in range(self.session.max_redirects + 1):
+            response = self.session.request(
+                'POST' if data is not None else 'GET',
+                url,
+                data=data,
+                headers=headers,
+                timeout=timeout or self.timeout,
+                allow_redirects=False)
+            if response.status_code not in REDIRECT_CODES or 'Location' not in response.headers:
+                break
+            url = urljoin(url, response.headers['Location'])
+            response.close()
+        else:
+            raise requests.TooManyRedirects('Exceeded %d redirects' % self.session.max_redirects)
+        response.raise_for_status()
+        return OpenerResponse(response)
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        requests_made = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+        return dict(
+            requests=requests_made,
+            connections=connections,
+            reused=requests_made - connections)
+
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+
+def get_transport_with_config(config):
+    # The backend and the cover art handler share one transport, so they
+    # also share its connection pool.
+    global _shared_transport
+    with _shared_transport_lock:
+        if _shared_transport is None:
+            subidy_config = config['subidy']
+            user_agent = httpclient.format_user_agent('{name}/{ver}'.format(
+                name=mopidy_subidy.SubidyExtension.dist_name,
+                ver=mopidy_subidy.__version__))
+            _shared_transport = PooledTransport(
+                pool_size=subidy_config['http_pool_size'],
+                timeout=subidy_config['http_timeout'],
+                proxy=httpclient.format_proxy(config['proxy']),
+                user_agent=user_agent)
+        return _shared_transport
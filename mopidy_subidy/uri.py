@@ -1,3 +1,4 @@
+import collections
 import re
 
 SONG = 'song'
@@ -9,7 +10,22 @@ VDIR = 'vdir'
 PREFIX = 'subidy'
 SEARCH = 'search'
 
+URI_PREFIX = PREFIX + ':'
+URI_PREFIX_LENGTH = len(URI_PREFIX)
+TYPES = frozenset((SONG, ARTIST, PLAYLIST, ALBUM, DIRECTORY, VDIR, SEARCH))
+
+PARSE_CACHE_SIZE = 10000
+
+ParsedUri = collections.namedtuple('ParsedUri', ['type', 'id'])
+INVALID = ParsedUri(None, None)
+# Skips the namedtuple's python level __new__, which on python 2 costs
+# about as much as the rest of parsing a uri.
+make_parsed_uri = tuple.__new__
+
 regex = re.compile(r'(\w+?):(\w+?)(?::|$)(.+?)?$')
+type_regex = re.compile(r'\w+\Z')
+
+parsed_uris = {}
 
 def is_type_result_valid(result):
     return result is not None and result.group(1) == PREFIX
@@ -20,47 +36,65 @@ def is_id_result_valid(result, type):
 def is_uri(uri):
     return regex.match(uri) is not None
 
+def parse_uncached(uri):
+    if not uri.startswith(URI_PREFIX):
+        return INVALID
+    if '\n' in uri:
+        # rare enough to leave to the regex and its newline semantics
+        result = regex.match(uri)
+        return ParsedUri(result.group(2), result.group(3)) if is_type_result_valid(result) else INVALID
+    type, _, id = uri[len(URI_PREFIX):].partition(':')
+    if type not in TYPES and type_regex.match(type) is None:
+        return INVALID
+    return ParsedUri(type, id or None)
+
+def parse(uri):
+    # Same results as matching `regex`, split in a single pass and memoized
+    # because lookups and browsing see the same uris over and over. Uris of
+    # a known type are split inline, everything else goes through
+    # parse_uncached.
+    parsed = parsed_uris.get(uri)
+    if parsed is not None:
+        return parsed
+    if uri.startswith(URI_PREFIX) and '\n' not in uri:
+        type, _, id = uri[URI_PREFIX_LENGTH:].partition(':')
+        if type in TYPES:
+            parsed = make_parsed_uri(ParsedUri, (type, id or None))
+    if parsed is None:
+        parsed = parse_uncached(uri)
+    if len(parsed_uris) >= PARSE_CACHE_SIZE:
+        parsed_uris.clear()
+    parsed_uris[uri] = parsed
+    return parsed
+
+def get_typed_id(uri, type):
+    # Indexing is cheaper than the namedtuple's properties on python 2.
+    parsed = parsed_uris.get(uri) or parse(uri)
+    return parsed[1] if parsed[0] == type else None
+
 def get_song_id(uri):
-    result = regex.match(uri)
-    if not is_id_result_valid(result, SONG):
-        return None
-    return result.group(3)
+    return get_typed_id(uri, SONG)
 
 def get_artist_id(uri):
-    result = regex.match(uri)
-    if not is_id_result_valid(result, ARTIST):
-        return None
-    return result.group(3)
+    return get_typed_id(uri, ARTIST)
 
 def get_playlist_id(uri):
-    result = regex.match(uri)
-    if not is_id_result_valid(result, PLAYLIST):
-        return None
-    return result.group(3)
+    return get_typed_id(uri, PLAYLIST)
 
 def get_album_id(uri):
-    result = regex.match(uri)
-    if not is_id_result_valid(result, ALBUM):
-        return None
-    return result.group(3)
+    return get_typed_id(uri, ALBUM)
 
 def get_directory_id(uri):
-    result = regex.match(uri)
-    if not is_id_result_valid(result, DIRECTORY):
-        return None
-    return result.group(3)
+    return get_typed_id(uri, DIRECTORY)
 
 def get_vdir_id(uri):
-    result = regex.match(uri)
-    if not is_id_result_valid(result, VDIR):
-        return None
-    return result.group(3)
+    return get_typed_id(uri, VDIR)
+
+def get_id(uri):
+    return parse(uri)[1]
 
 def get_type(uri):
-    result = regex.match(uri)
-    if not is_type_result_valid(result):
-        return None
-    return result.group(2)
+    return parse(uri)[0]
 
 def get_type_uri(type, id):
     return u'%s:%s:%s' % (PREFIX, type, id)